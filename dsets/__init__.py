@@ -1,5 +1,6 @@
 from .attr_snippets import AttributeSnippets
 from .counterfact import CounterFactDataset
 from .knowns import KnownsDataset
+from .local_corpus import LocalTextDataset
 from .tfidf_stats import get_tfidf_vectorizer
 from .zsre import MENDQADataset
@@ -0,0 +1,77 @@
+import gzip
+import json
+import random
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from torch.utils.data import Dataset
+
+TEXT_SUFFIXES = {".txt"}
+JSONL_SUFFIXES = {".jsonl", ".jsonl.gz"}
+
+
+def iter_local_texts(path: Union[str, Path], field: str = "text") -> Iterator[str]:
+    """
+    Streams documents from a local corpus, in a fixed order: a single file,
+    or every file below a directory, sorted by path. Each .txt file is one
+    document; each line of a .jsonl (or .jsonl.gz) file is a JSON object
+    whose `field` is one document.
+    """
+
+    path = Path(path)
+    if path.is_file():
+        files = [path]
+    else:
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+    for f in files:
+        suffix = "".join(f.suffixes[-2:]) if f.name.endswith(".gz") else f.suffix
+        if suffix in TEXT_SUFFIXES:
+            yield f.read_text(encoding="utf-8", errors="replace")
+        elif suffix in JSONL_SUFFIXES:
+            opener = gzip.open if suffix.endswith(".gz") else open
+            with opener(f, "rt", encoding="utf-8") as lines:
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)[field]
+
+
+class LocalTextDataset(Dataset):
+    """
+    A fixed random sample of documents from a local corpus (see
+    `iter_local_texts`), drawn with reservoir sampling in one sequential
+    read. Memory is bounded by the sample, and the sample only depends on
+    the corpus, `sample_size` and `seed`. Items are {"text": ...} dicts, as
+    in Hugging Face text datasets, so the dataset can be wrapped by
+    TokenizedDataset or pretokenized.
+
+    If sample_size is None, the whole corpus is loaded.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        sample_size: Optional[int] = None,
+        seed: int = 1,
+        field: str = "text",
+    ):
+        rng = random.Random(seed)
+        texts, n_seen = [], 0
+        for text in iter_local_texts(path, field=field):
+            if sample_size is None or len(texts) < sample_size:
+                texts.append(text)
+            else:
+                j = rng.randrange(n_seen + 1)
+                if j < sample_size:
+                    texts[j] = text
+            n_seen += 1
+        # Reservoir positions are not uniformly ordered; shuffle them.
+        rng.shuffle(texts)
+
+        self.texts = texts
+        print(f"Sampled {len(texts)} of {n_seen} documents from {path}")
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __getitem__(self, item):
+        return dict(text=self.texts[item])
@@ -14,7 +14,7 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 
 sys.path.append("/workspace/rebuilding-rome")
 
-from dsets import KnownsDataset
+from dsets import KnownsDataset, LocalTextDataset
 from rome.tok_dataset import (
     TokenizedDataset,
     dict_to_,
@@ -56,6 +56,7 @@ def main():
     aa("--output_dir", default="results/{model_name}/causal_trace")
     aa("--noise_level", default="s3", type=parse_noise_rule)
     aa("--replace", default=0, type=int)
+    aa("--local_corpus", default=None, help="Text/JSONL file or directory to sample")
     args = parser.parse_args()
 
     modeldir = f'r{args.replace}_{args.model_name.replace("/", "_")}'
@@ -89,12 +90,12 @@ def main():
             print(f"Using noise_level {noise_level} to match model times {factor}")
         elif noise_level == "m":
             # Automatic multivariate gaussian
-            noise_level = collect_embedding_gaussian(mt)
+            noise_level = collect_embedding_gaussian(mt, args.local_corpus)
             print(f"Using multivariate gaussian to match model noise")
         elif noise_level.startswith("t"):
             # Automatic d-distribution with d degrees of freedom
             degrees = float(noise_level[1:])
-            noise_level = collect_embedding_tdist(mt, degrees)
+            noise_level = collect_embedding_tdist(mt, degrees, args.local_corpus)
         elif noise_level.startswith("u"):
             uniform_noise = True
             noise_level = float(noise_level[1:])
@@ -651,32 +652,36 @@ def collect_embedding_std(mt, subjects):
     alldata = []
     for s in subjects:
         inp = make_inputs(mt.tokenizer, [s])
-        with nethook.Trace(mt.model, layername(mt.model, 0, "embed")) as t:
+        with nethook.Trace(mt.model, layername(mt.model, 0, "embed"), stop=True) as t:
             mt.model(**inp)
-            alldata.append(t.output[0])
+        alldata.append(t.output[0])
     alldata = torch.cat(alldata)
     noise_level = alldata.std().item()
     return noise_level
 
 
-def get_embedding_cov(mt):
+def get_embedding_cov(mt, local_corpus=None):
     model = mt.model
     tokenizer = mt.tokenizer
+    sample_size = 1000
 
     def get_ds():
-        ds_name = "wikitext"
-        raw_ds = load_dataset(
-            ds_name,
-            dict(wikitext="wikitext-103-raw-v1", wikipedia="20200501.en")[ds_name],
-        )
+        if local_corpus is not None:
+            # Reservoir-sampled in one pass, without downloading anything
+            raw_ds = LocalTextDataset(local_corpus, sample_size=sample_size)
+        else:
+            ds_name = "wikitext"
+            raw_ds = load_dataset(
+                ds_name,
+                dict(wikitext="wikitext-103-raw-v1", wikipedia="20200501.en")[ds_name],
+            )["train"]
         try:
             maxlen = model.config.n_positions
         except:
             maxlen = 100  # Hack due to missing setting in GPT2-NeoX.
-        return TokenizedDataset(raw_ds["train"], tokenizer, maxlen=maxlen)
+        return TokenizedDataset(raw_ds, tokenizer, maxlen=maxlen)
 
     ds = get_ds()
-    sample_size = 1000
     batch_size = 5
     filename = None
     batch_tokens = 100
@@ -700,7 +705,9 @@ def get_embedding_cov(mt):
             for batch in batch_group:
                 batch = dict_to_(batch, "cuda")
                 del batch["position_ids"]
-                with nethook.Trace(model, layername(mt.model, 0, "embed")) as tr:
+                with nethook.Trace(
+                    model, layername(mt.model, 0, "embed"), stop=True
+                ) as tr:
                     model(**batch)
                 feats = flatten_masked_batch(tr.output, batch["attention_mask"])
                 stat.add(feats.cpu().double())
@@ -723,12 +730,12 @@ def make_generator_transform(mean=None, cov=None):
     return layer
 
 
-def collect_embedding_gaussian(mt):
-    m, c = get_embedding_cov(mt)
+def collect_embedding_gaussian(mt, local_corpus=None):
+    m, c = get_embedding_cov(mt, local_corpus)
     return make_generator_transform(m, c)
 
 
-def collect_embedding_tdist(mt, degree=3):
+def collect_embedding_tdist(mt, degree=3, local_corpus=None):
     # We will sample sqrt(degree / u) * sample, where u is from the chi2[degree] dist.
     # And this will give us variance is (degree / degree - 2) * cov.
     # Therefore if we want to match the sample variance, we should
@@ -738,7 +745,7 @@ def collect_embedding_tdist(mt, degree=3):
         numpy.random.RandomState(2).chisquare(df=degree, size=1000)
     )
     fixed_sample = ((degree - 2) / u_sample).sqrt()
-    mvg = collect_embedding_gaussian(mt)
+    mvg = collect_embedding_gaussian(mt, local_corpus)
 
     def normal_to_student(x):
         gauss = mvg(x)
@@ -2,6 +2,7 @@ import json
 import os
 import shutil
 import sys
+from functools import partial
 from itertools import islice
 from time import time
 from typing import Tuple, Union
@@ -19,11 +20,27 @@ from dsets import (
     MENDQADataset,
     get_tfidf_vectorizer,
 )
-from experiments.py.eval_utils_counterfact import compute_rewrite_quality_counterfact
-from experiments.py.eval_utils_zsre import compute_rewrite_quality_zsre
+from experiments.py.eval_utils_baseline import BaselineStore
+from experiments.py.eval_utils_counterfact import (
+    compute_generation_counterfact,
+    compute_rewrite_quality_counterfact,
+    compute_rewrite_scores_counterfact,
+)
+from experiments.py.eval_utils_zsre import (
+    compute_rewrite_quality_zsre,
+    compute_rewrite_scores_zsre,
+)
 from glue_eval.glue_eval import GLUEEval
-from rome import ROMEHyperParams, apply_rome_to_model
+from rome import (
+    EditOverlay,
+    ROMEHyperParams,
+    apply_rome_to_model,
+    get_context_templates,
+)
 from util import nethook
+from util.activation_cache import ActivationCache
+from util.edit_distance import EditDistanceTracker
+from util.edit_journal import EditJournal
 from util.globals import *
 
 ALG_DICT = {
@@ -33,8 +50,12 @@ ALG_DICT = {
 }
 
 DS_DICT = {
-    "cf": (CounterFactDataset, compute_rewrite_quality_counterfact),
-    "zsre": (MENDQADataset, compute_rewrite_quality_zsre),
+    "cf": (
+        CounterFactDataset,
+        compute_rewrite_quality_counterfact,
+        compute_rewrite_scores_counterfact,
+    ),
+    "zsre": (MENDQADataset, compute_rewrite_quality_zsre, compute_rewrite_scores_zsre),
 }
 
 
@@ -52,6 +73,13 @@ def main(
     dir_name: str,
     num_edits: int = 1,
     use_cache: bool = False,
+    regenerate_context_templates: bool = False,
+    use_overlay: bool = False,
+    use_journal: bool = False,
+    use_baseline: bool = False,
+    activation_cache: str = None,
+    generation_batch_records: int = 1,
+    score_batch_records: int = 1,
 ):
     # Set algorithm-specific variables
     params_class, apply_algo = ALG_DICT[alg_name]
@@ -115,13 +143,41 @@ def main(
     if type(model_name) is str:
         print("Instantiating model")
         model = AutoModelForCausalLM.from_pretrained(model_name).cuda()
-        original_model = AutoModelForCausalLM.from_pretrained(model_name)
         tok = AutoTokenizer.from_pretrained(model_name)
         tok.pad_token = tok.eos_token
     else:
         model, tok = model_name
         model_name = model.config._name_or_path
 
+    if alg_name == "ROME":
+        # Load the context templates up front, sampling them only if needed
+        get_context_templates(
+            model,
+            tok,
+            hparams.context_template_length_params,
+            regenerate=regenerate_context_templates,
+        )
+
+    # Keep ROME edits as low-rank factors instead of writing them into the weights
+    overlay = None
+    if use_overlay:
+        assert alg_name == "ROME", "Edit overlays are only supported for ROME"
+        overlay = EditOverlay(model)
+
+    # Record every applied edit, so that any prefix of the run can be rebuilt
+    journal = None
+    if use_journal:
+        # Non-sequential runs restore the weights after every edit, which a
+        # replay of the journal would not undo
+        assert sequential, "Edit journals are only supported with --sequential"
+    if use_journal and not args.debug:
+        journal = EditJournal(run_dir / "journal")
+        print(f"Edits will be journaled at {journal.path}")
+
+    # Only the rewritten weights are kept, to measure how far edits move them
+    distance_weights = get_rewrite_weight_names(hparams)
+    distance_tracker = EditDistanceTracker(model, list(distance_weights.values()))
+
     # Load data
     print("Loading dataset, attribute snippets, tf-idf data")
     snips = AttributeSnippets(DATA_DIR) if not skip_generation_tests else None
@@ -130,7 +186,7 @@ def main(
     if num_edits > 1:
         assert ds_name != "cf", f"{ds_name} does not support multiple edits"
 
-    ds_class, ds_eval_method = DS_DICT[ds_name]
+    ds_class, ds_eval_method, ds_score_method = DS_DICT[ds_name]
     ds = ds_class(DATA_DIR, tok=tok, size=dataset_size_limit)
 
     # Get cache templates
@@ -152,10 +208,63 @@ def main(
         with open("data/disabling_edits_zsre.json") as json_file:
             selected_indices = json.load(json_file)
 
+    # Edits leave the residual stream below the lowest edited layer unchanged;
+    # probability tests resume from it
+    act_cache = None
+    if activation_cache is not None:
+        assert alg_name == "ROME", "Activation caches are only supported for ROME"
+        cache_layer = min(hparams.layers)
+        act_cache = ActivationCache(
+            hparams.layer_module_tmp,
+            cache_layer,
+            hparams.ln_f_module,
+            path=(
+                RESULTS_DIR
+                / "activations"
+                / f"{model_name.replace('/', '_')}_layer_{cache_layer}"
+                if activation_cache == "disk"
+                else None
+            ),
+        )
+        ds_score_method = partial(ds_score_method, activation_cache=act_cache)
+
+    # Pre-edit scores are shared by all runs on the model; compute missing ones
+    # once, before anything is edited
+    baseline = None
+    if use_baseline:
+        baseline = BaselineStore.for_model(model_name, ds_name)
+        baseline.update(
+            model,
+            tok,
+            [
+                record
+                for record_chunks in chunks(ds, num_edits)
+                if selected_indices[str(record_chunks[0]["case_id"])]
+                for record in record_chunks
+            ],
+            ds_score_method,
+        )
+
     # Iterate through dataset
     glue_save_location = str(run_dir) + "/" + "glue_eval/"
     os.makedirs(glue_save_location, exist_ok=True)
 
+    # Without sequential edits, generation tests of several records can share
+    # one batch on the restored model, each row under its own record's edits
+    batch_generation = (
+        generation_batch_records > 1
+        and not sequential
+        and alg_name == "ROME"
+        and ds_name == "cf"
+        and snips is not None
+    )
+    queued_generation = []
+
+    # Likewise, the probability tests of several records can be scored
+    # together once the weights are restored
+    batch_scoring = score_batch_records > 1 and not sequential and alg_name == "ROME"
+    queued_scoring = []
+
     count = 0
     # Iterate through dataset
     for r, record_chunks in enumerate(chunks(ds, num_edits)):
@@ -184,6 +293,12 @@ def main(
             if conserve_memory
             else dict()
         )
+        if overlay is not None:
+            args_conserve_memory["overlay"] = overlay
+        if journal is not None and alg_name == "ROME":
+            args_conserve_memory["journal"] = journal
+        if alg_name == "ROME":
+            args_conserve_memory["distance_tracker"] = distance_tracker
 
         start = time()
         edited_model, weights_copy = apply_algo(
@@ -202,36 +317,88 @@ def main(
         exec_time = time() - start
         print("Execution took", exec_time)
 
+        if alg_name != "ROME":
+            # Other algorithms have no low-rank factors; record their dense updates
+            with torch.no_grad():
+                dense_deltas = {
+                    k: nethook.get_parameter(edited_model, k) - v.to("cuda")
+                    for k, v in weights_copy.items()
+                }
+            if journal is not None:
+                journal.append(dense_deltas)
+            distance_tracker.append(dense_deltas)
+            del dense_deltas
+
         # Evaluate new model
         start = time()
         gen_test_vars = [snips, vec]
+        distance = get_model_distance(distance_tracker, distance_weights, edited_model)
+        scores, deltas = {}, None
+        if batch_scoring:
+            deltas = distance_tracker.deltas()
+        else:
+            # All records of the chunk are evaluated on the same model; score
+            # their prompts together
+            pending = [
+                record
+                for record in record_chunks
+                if not Path(
+                    case_result_template.format(num_edits, record["case_id"])
+                ).exists()
+            ]
+            scores = ds_score_method(edited_model, tok, pending)
+            scores = {record["case_id"]: s for record, s in zip(pending, scores)}
         for record in record_chunks:
             out_file = Path(case_result_template.format(num_edits, record["case_id"]))
             if out_file.exists():
                 print(f"Skipping {out_file}; already exists")
                 continue
 
-            distance = get_model_distance(original_model, edited_model, hparams)
-
+            # Only test generation every generation_test_interval cases
+            test_generation = record["case_id"] % generation_test_interval == 0
+            defer_generation = test_generation and batch_generation
             metrics = {
                 "case_id": record["case_id"],
                 "grouped_case_ids": case_ids,
                 "num_edits": num_edits,
                 "requested_rewrite": record["requested_rewrite"],
                 "time": exec_time,
-                "post": ds_eval_method(
-                    edited_model,
-                    tok,
-                    record,
-                    *(
-                        gen_test_vars
-                        if record["case_id"] % generation_test_interval == 0
-                        else [None, None]
-                    ),  # Only test generation every generation_test_interval cases
+                **(
+                    {"pre": baseline.get(record["case_id"])}
+                    if baseline is not None
+                    else {}
                 ),
+                "post": None,
                 "distance_from_original": distance,
             }
 
+            if batch_scoring:
+                queue_generation = (
+                    test_generation and ds_name == "cf" and snips is not None
+                )
+                queued_scoring.append(
+                    (out_file, metrics, record, deltas, queue_generation)
+                )
+                continue
+
+            metrics["post"] = ds_eval_method(
+                edited_model,
+                tok,
+                record,
+                *(
+                    gen_test_vars
+                    if test_generation and not defer_generation
+                    else [None, None]
+                ),
+                scores=scores[record["case_id"]],
+            )
+
+            if defer_generation:
+                queued_generation.append(
+                    (out_file, metrics, record, distance_tracker.deltas())
+                )
+                continue
+
             # Dump metrics in .json
             if not args.debug:
                 with open(out_file, "w") as f:
@@ -258,8 +425,6 @@ def main(
 
         if count % 20 == 0:
             # Do GLUE EVALUATION
-            distance = get_model_distance(original_model, edited_model, hparams)
-
             glue_results = {
                 "edit_num": r,
                 "case_id": case_ids,
@@ -285,33 +450,117 @@ def main(
 
         if not sequential:
             # Restore original weights
+            if overlay is not None:
+                overlay.clear()
             with torch.no_grad():
                 for k, v in weights_copy.items():
                     nethook.get_parameter(model, k)[...] = v.to("cuda")
+            distance_tracker.reset()
+
+        if len(queued_scoring) >= score_batch_records:
+            run_queued_scoring(
+                model,
+                tok,
+                queued_scoring,
+                ds_eval_method,
+                ds_score_method,
+                queued_generation,
+            )
+        if len(queued_generation) >= generation_batch_records:
+            run_queued_generation(model, tok, queued_generation, snips, vec)
 
         print("Evaluation took", time() - start)
+        if act_cache is not None:
+            print(
+                f"Activation cache: {len(act_cache)} prompts, "
+                f"{act_cache.hits} batches resumed, {act_cache.misses} computed"
+            )
+
+    if len(queued_scoring) > 0:
+        run_queued_scoring(
+            model,
+            tok,
+            queued_scoring,
+            ds_eval_method,
+            ds_score_method,
+            queued_generation,
+        )
+    if len(queued_generation) > 0:
+        run_queued_generation(model, tok, queued_generation, snips, vec)
+
+
+def run_queued_scoring(
+    model, tok, queue, ds_eval_method, ds_score_method, queued_generation
+):
+    """
+    Scores the probability tests of queued (out_file, metrics, record, deltas,
+    test_generation) entries together on the unedited model, applying each
+    record's edit to its own rows. Entries that still need generation tests
+    move on to `queued_generation`; the others have their metrics dumped.
+    """
+    print(f"Scoring the probability tests of {len(queue)} records")
+    scores = ds_score_method(
+        model,
+        tok,
+        [record for _, _, record, _, _ in queue],
+        edits=[deltas for _, _, _, deltas, _ in queue],
+    )
+    for (out_file, metrics, record, deltas, test_generation), s in zip(queue, scores):
+        metrics["post"] = ds_eval_method(model, tok, record, None, None, scores=s)
+        if test_generation:
+            queued_generation.append((out_file, metrics, record, deltas))
+            continue
 
+        # Dump metrics in .json
+        if not args.debug:
+            with open(out_file, "w") as f:
+                json.dump(metrics, f, indent=1)
+    queue.clear()
+
+
+def run_queued_generation(model, tok, queue, snips, vec):
+    """
+    Runs the generation tests of queued (out_file, metrics, record, deltas)
+    entries in one batch on the unedited model, applying each record's edit
+    to its own rows, then completes and dumps their metrics.
+    """
+    print(f"Running generation tests of {len(queue)} records")
+    gen_stats = compute_generation_counterfact(
+        model,
+        tok,
+        [record for _, _, record, _ in queue],
+        snips,
+        vec,
+        edits=[deltas for _, _, _, deltas in queue],
+    )
+    for (out_file, metrics, _, _), stats in zip(queue, gen_stats):
+        metrics["post"].update(stats)
 
-def get_model_distance(original_model, model_new, model_hpar):
-    state_dict_original = original_model.state_dict()
-    state_dict_new = model_new.state_dict()
+        # Dump metrics in .json
+        if not args.debug:
+            with open(out_file, "w") as f:
+                json.dump(metrics, f, indent=1)
+    queue.clear()
 
-    distances_dict = {}
+
+def get_rewrite_weight_names(model_hpar):
+    """
+    Maps each of the hparams' layers to the name of the weight it rewrites.
+    """
+    weight_names = {}
     for layer in model_hpar.layers:
         if isinstance(layer, str) and "transformer" in layer:
-            rewrite_layer = layer
+            weight_names[layer] = layer
         else:
-            rewrite_layer = model_hpar.rewrite_module_tmp.format(str(layer)) + ".weight"
-
-        distance = (
-            torch.norm(
-                state_dict_original[rewrite_layer] - state_dict_new[rewrite_layer].cpu()
+            weight_names[layer] = (
+                model_hpar.rewrite_module_tmp.format(str(layer)) + ".weight"
             )
-            / state_dict_original[rewrite_layer].numel()
-        )
-        distances_dict[layer] = distance.detach().cpu().item()
+    return weight_names
 
-    return distances_dict
+
+def get_model_distance(distance_tracker, weight_names, model_new):
+    distances = distance_tracker.distances(model_new)
+    return {layer: distances[w_name] for layer, w_name in weight_names.items()}
 
 
 def window(seq, n=2):
@@ -420,6 +669,58 @@ if __name__ == "__main__":
         action="store_true",
         help="If we want to do sequential editing or not",
     )
+    parser.add_argument(
+        "--regenerate_context_templates",
+        dest="regenerate_context_templates",
+        action="store_true",
+        help="Sample ROME's context templates anew instead of loading them from disk.",
+    )
+    parser.add_argument(
+        "--use_overlay",
+        dest="use_overlay",
+        action="store_true",
+        help="Keep ROME edits as low-rank factors applied through hooks, "
+        "instead of writing them into the model weights.",
+    )
+    parser.add_argument(
+        "--use_journal",
+        dest="use_journal",
+        action="store_true",
+        help="Append the weight deltas of every edit to <run_dir>/journal, "
+        "from which any prefix of the edit history can be replayed. "
+        "Requires --sequential.",
+    )
+    parser.add_argument(
+        "--use_baseline",
+        dest="use_baseline",
+        action="store_true",
+        help="Add the unedited model's scores to every case as its pre block. "
+        "They are computed once per model and dataset, and cached under "
+        "<RESULTS_DIR>/baselines.",
+    )
+    parser.add_argument(
+        "--activation_cache",
+        choices=["memory", "disk"],
+        default=None,
+        help="Cache every eval prompt's hidden states below the edited layer, in "
+        "memory or under <RESULTS_DIR>/activations, and resume probability "
+        "tests from them. The memory cache only keeps the most recently used "
+        "states, up to 4 GiB; use disk to cache a whole dataset.",
+    )
+    parser.add_argument(
+        "--generation_batch_records",
+        type=int,
+        default=1,
+        help="Without --sequential, queue the generation tests of this many "
+        "records and run them in one batch, each under its own edit.",
+    )
+    parser.add_argument(
+        "--score_batch_records",
+        type=int,
+        default=1,
+        help="Without --sequential, queue the probability tests of this many "
+        "records and score them in one call, each under its own edit.",
+    )
     parser.set_defaults(skip_generation_tests=False, conserve_memory=False)
     args = parser.parse_args()
 
@@ -441,4 +742,11 @@ if __name__ == "__main__":
         dir_name=args.alg_name,
         num_edits=args.num_edits,
         use_cache=args.use_cache,
+        regenerate_context_templates=args.regenerate_context_templates,
+        use_overlay=args.use_overlay,
+        use_journal=args.use_journal,
+        use_baseline=args.use_baseline,
+        activation_cache=args.activation_cache,
+        generation_batch_records=args.generation_batch_records,
+        score_batch_records=args.score_batch_records,
     )
@@ -6,7 +6,7 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from baselines.ft import FTHyperParams, apply_ft_to_model
-from rome import ROMEHyperParams, apply_rome_to_model
+from rome import ROMEHyperParams, apply_rome_to_model, get_context_templates
 from util import nethook
 from util.generate import generate_fast
 from util.globals import *
@@ -18,11 +18,15 @@ def demo_model_editing(
     requests: List[Dict],
     generation_prompts: List[str],
     alg_name: str = "ROME",
+    regenerate_context_templates: bool = False,
 ) -> Tuple[AutoModelForCausalLM, Dict[str, torch.Tensor]]:
     """
     Applies the selected model editing algorithm. Generates text both before and after
     for comparison of model behavior. Returns the updated model and the original values of
     weights that were changed.
+
+    For ROME, context templates are loaded from disk unless
+    `regenerate_context_templates` is set.
     """
 
     nethook.set_requires_grad(True, model)
@@ -41,6 +45,14 @@ def demo_model_editing(
     hparams = RewritingParamsClass.from_json(params_name)
     print(hparams)
 
+    if alg_name == "ROME":
+        get_context_templates(
+            model,
+            tok,
+            hparams.context_template_length_params,
+            regenerate=regenerate_context_templates,
+        )
+
     print_loud("Generating pre-update text")
     pre_update_text = generate_fast(model, tok, generation_prompts, max_out_len=100)
     print(pre_update_text)
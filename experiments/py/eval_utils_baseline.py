@@ -0,0 +1,216 @@
+"""
+Store of the unedited model's scores on the records of a dataset. They are
+the same for every run, sweep value and algorithm on a given model, so they
+are computed once, in large batches, and joined into results as the "pre"
+block that summarize.py reads.
+"""
+
+import os
+import typing
+from pathlib import Path
+
+import numpy as np
+
+from util.globals import *
+
+
+class BaselineStore:
+    """
+    Pre-edit scores of one model on one dataset, indexed by case_id and
+    stored column-wise in a single .npz file. Every metric of a record is a
+    list, of scalars or of dicts of scalars; each such list is stored as a
+    flat column per field (named "<metric>.<field>", or "<metric>.values"
+    for scalars) plus a "<metric>.length" column with one entry per record.
+
+        store = BaselineStore.for_model("gpt2-xl", "cf")
+        store.update(model, tok, records, compute_rewrite_scores_counterfact)
+        pre = store.get(record["case_id"])
+    """
+
+    def __init__(self, path: typing.Union[str, Path]):
+        self.path = Path(path)
+        self.columns = {}
+        if self.path.exists():
+            with np.load(self.path) as data:
+                self.columns = {k: data[k] for k in data.files}
+        self._index()
+
+    @classmethod
+    def for_model(cls, model_name: str, ds_name: str):
+        return cls(
+            RESULTS_DIR / "baselines" / f"{model_name.replace('/', '_')}_{ds_name}.npz"
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, case_id):
+        return case_id in self.rows
+
+    def get(self, case_id) -> typing.Dict:
+        """
+        Returns the scores of a record, in the format they were computed in.
+        """
+
+        i = self.rows[case_id]
+        ret = {}
+        for metric, fields in self.metrics.items():
+            start = self.offsets[metric][i]
+            end = start + self.columns[f"{metric}.length"][i]
+            if fields == ["values"]:
+                ret[metric] = self.columns[f"{metric}.values"][start:end].tolist()
+            else:
+                values = [self.columns[f"{metric}.{f}"][start:end] for f in fields]
+                ret[metric] = [
+                    {f: x.item() for f, x in zip(fields, row)} for row in zip(*values)
+                ]
+        return ret
+
+    def update(
+        self,
+        model,
+        tok,
+        records: typing.List[typing.Dict],
+        score_method: typing.Callable,
+        chunk_size: int = 256,
+    ):
+        """
+        Scores the records that are not stored yet with `score_method`, e.g.
+        `compute_rewrite_scores_counterfact`, `chunk_size` records per call,
+        and saves them. The model must be unedited.
+        """
+
+        missing = [r for r in records if r["case_id"] not in self.rows]
+        if len(missing) == 0:
+            return
+        print(f"Computing pre-edit scores of {len(missing)} records")
+
+        new_columns = {"case_id": [r["case_id"] for r in missing]}
+        for i in range(0, len(missing), chunk_size):
+            for scores in score_method(model, tok, missing[i : i + chunk_size]):
+                for metric, values in scores.items():
+                    new_columns.setdefault(f"{metric}.length", []).append(len(values))
+                    for value in values:
+                        if not isinstance(value, dict):
+                            value = dict(values=value)
+                        for field, x in value.items():
+                            new_columns.setdefault(f"{metric}.{field}", []).append(x)
+            print(f"Scored {min(i + chunk_size, len(missing))} of {len(missing)}")
+
+        for k, v in new_columns.items():
+            v = np.asarray(v)
+            if k in self.columns:
+                v = np.concatenate([self.columns[k], v])
+            self.columns[k] = v
+        self._index()
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = self.path.with_name(f"{self.path.stem}.tmp{os.getpid()}.npz")
+        np.savez(tmp_path, **self.columns)
+        os.replace(tmp_path, self.path)
+        print(f"Saved pre-edit scores of {len(self)} records to {self.path}")
+
+    def _index(self):
+        case_ids = self.columns["case_id"].tolist() if self.columns else []
+        self.rows = {case_id: i for i, case_id in enumerate(case_ids)}
+        self.metrics, self.offsets = {}, {}
+        for name in self.columns:
+            if name.endswith(".length"):
+                metric = name[: -len(".length")]
+                self.offsets[metric] = np.concatenate(
+                    [[0], np.cumsum(self.columns[name])[:-1]]
+                )
+                self.metrics[metric] = []
+        for name in self.columns:
+            metric, _, field = name.rpartition(".")
+            if metric in self.metrics and field != "length":
+                self.metrics[metric].append(field)
+
+
+# Unit Tests
+def _unit_test():
+    import tempfile
+
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    from experiments.py.eval_utils_counterfact import (
+        compute_rewrite_scores_counterfact,
+    )
+    from experiments.py.eval_utils_zsre import compute_rewrite_scores_zsre
+
+    words = "[PAD] The Eiffel Tower is in Rome Paris Danielle Darrieux speaks English a"
+    vocab = {w: i for i, w in enumerate(words.split())}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[PAD]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tok = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]")
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(
+            n_layer=4, n_embd=32, n_head=4, n_positions=32, vocab_size=len(vocab)
+        )
+    ).eval()
+
+    facts = [
+        ("The Eiffel Tower", "{} is in", "Rome", "Paris"),
+        ("Danielle Darrieux", "{} speaks", "English a", "Paris"),
+        ("Paris", "{} is in", "Rome", "a"),
+        ("The Eiffel Tower", "a {} speaks", "English", "Danielle Darrieux"),
+    ]
+    records = [
+        dict(
+            case_id=10 * i,
+            requested_rewrite=dict(
+                prompt=prompt,
+                subject=subject,
+                target_new=dict(str=new),
+                target_true=dict(str=true),
+            ),
+            paraphrase_prompts=[f"a {prompt.format(subject)}"] * (i % 2 + 1),
+            neighborhood_prompts=[dict(prompt="Paris is in", target="Rome")],
+            attribute_prompts=[] if i == 2 else ["Danielle Darrieux is in"],
+        )
+        for i, (subject, prompt, new, true) in enumerate(facts)
+    ]
+    cf_records = [
+        dict(r, neighborhood_prompts=[n["prompt"] for n in r["neighborhood_prompts"]])
+        for r in records
+    ]
+
+    def close(a, b):
+        if isinstance(a, dict):
+            return a.keys() == b.keys() and all(close(a[k], b[k]) for k in a)
+        if isinstance(a, list):
+            return len(a) == len(b) and all(close(x, y) for x, y in zip(a, b))
+        return type(a) is type(b) and abs(a - b) < 1e-5
+
+    with torch.no_grad(), tempfile.TemporaryDirectory() as tmp:
+        for score_method, ds in [
+            (compute_rewrite_scores_counterfact, cf_records),
+            (compute_rewrite_scores_zsre, records),
+        ]:
+            path = Path(tmp) / f"{score_method.__name__}.npz"
+            store = BaselineStore(path)
+            store.update(model, tok, ds[:2], score_method)
+            store.update(model, tok, ds[2:], score_method, chunk_size=1)
+            assert len(store) == len(ds)
+
+            # Reopened from disk, every record reads back as computed
+            store = BaselineStore(path)
+            assert len(store) == len(ds) and 30 in store and 40 not in store
+            for record, expected in zip(ds, score_method(model, tok, ds)):
+                pre = store.get(record["case_id"])
+                assert close(pre, expected), (record["case_id"], pre, expected)
+
+            # Stored records are not scored again
+            store.update(model, tok, ds, None)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
@@ -5,18 +5,20 @@ appropriate arguments, which returns a dictionary containing them.
 """
 
 import typing
+from contextlib import nullcontext
 from itertools import chain
 
 import nltk
 import numpy as np
 import scipy
-import torch
 from sklearn.feature_extraction.text import TfidfVectorizer
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from dsets import AttributeSnippets
+from experiments.py.eval_utils_scoring import score_targets
+from rome import RowwiseEdits
 from util.generate import generate_fast
-from util.perplexity import perplexity
+from util.perplexity import perplexity_batch
 
 
 def compute_rewrite_quality_counterfact(
@@ -25,6 +27,8 @@ def compute_rewrite_quality_counterfact(
     record: typing.Dict,
     snips: AttributeSnippets,
     vec: TfidfVectorizer,
+    scores: typing.Optional[typing.Dict] = None,
+    activation_cache=None,
 ) -> typing.Dict:
     """
     Given a rewritten model, computes generalization and specificity metrics for
@@ -36,115 +40,182 @@ def compute_rewrite_quality_counterfact(
     :param record: CounterFact dataset record
     :paran snips: ???
     :param vec: ???
+    :param scores: This record's output of `compute_rewrite_scores_counterfact`,
+        if already computed along with other records.
+    :param activation_cache: An `ActivationCache` below the edited layer, from
+        which the forward passes of probability tests resume.
 
     :return: Dictionary containing rewriting metrics
     """
 
-    # First, unpack rewrite evaluation record.
-    subject, target_new, target_true = (
-        record["requested_rewrite"][x] for x in ["subject", "target_new", "target_true"]
-    )
-    rewrite_prompts = [record["requested_rewrite"]["prompt"].format(subject)]
-    paraphrase_prompts = record["paraphrase_prompts"]
-    neighborhood_prompts = record["neighborhood_prompts"]
-    attribute_prompts = record["attribute_prompts"]
-    generation_prompts = record["generation_prompts"]
-
-    # Form a list of lists of prefixes to test.
-    prob_prompts = [
-        rewrite_prompts,
-        paraphrase_prompts,
-        neighborhood_prompts,
-        attribute_prompts,
-    ]
-    # Flatten all the evaluated prefixes into one list.
-    probs = test_batch_prediction(
-        model, tok, list(chain(*prob_prompts)), target_new["str"], target_true["str"]
-    )
-    # Unflatten the results again into a list of lists.
-    cutoffs = [0] + np.cumsum(list(map(len, prob_prompts))).tolist()
-    ret_probs = [probs[cutoffs[i - 1] : cutoffs[i]] for i in range(1, len(cutoffs))]
-    # Structure the restuls as a dictionary.
-    ret = {
-        f"{key}_probs": ret_probs[i]
-        for i, key in enumerate(
-            [
-                "rewrite_prompts",
-                "paraphrase_prompts",
-                "neighborhood_prompts",
-                "attribute_prompts",
-            ]
-        )
-    }
+    if scores is None:
+        scores = compute_rewrite_scores_counterfact(
+            model, tok, [record], activation_cache=activation_cache
+        )[0]
+    ret = dict(scores)
 
     if snips is not None:
+        ret.update(compute_generation_counterfact(model, tok, [record], snips, vec)[0])
+
+    return ret
+
+
+def compute_generation_counterfact(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    records: typing.List[typing.Dict],
+    snips: AttributeSnippets,
+    vec: TfidfVectorizer,
+    edits: typing.Optional[typing.List[typing.Dict]] = None,
+) -> typing.List[typing.Dict]:
+    """
+    Computes the generation metrics of `compute_rewrite_quality_counterfact`
+    for several records at once, generating from all of their prompts in one
+    batch.
+
+    :param edits: If given, the edit set of each record, in the format of
+        `EditOverlay.add`. They are applied through `RowwiseEdits` to the
+        rows of their own record only, so the records may have been edited
+        independently; `model` should then be unedited.
+    """
+
+    prefixes, consistency_texts, essence_texts = [], [], []
+    for record in records:
         # Gather reference texts
+        target_new = record["requested_rewrite"]["target_new"]
         rel_id = record["requested_rewrite"]["relation_id"]
-        consistency_texts = [x["text"] for x in snips[rel_id][target_new["id"]]]
-        essence_texts = [
-            x["text"]
-            for x in snips[rel_id][target_new["id"]]
-            if x["name"] == record["requested_rewrite"]["subject"]
-        ]
+        consistency_texts.append([x["text"] for x in snips[rel_id][target_new["id"]]])
+        essence_texts.append(
+            [
+                x["text"]
+                for x in snips[rel_id][target_new["id"]]
+                if x["name"] == record["requested_rewrite"]["subject"]
+            ]
+        )
         assert (
-            len(consistency_texts) > 0
+            len(consistency_texts[-1]) > 0
         ), "Must have consistency texts to evaluate generation"
-        gen_stats = test_generation(
-            model,
-            tok,
-            generation_prompts,
-            consistency_texts,
-            essence_texts,
-            vec,
+        prefixes.append(record["generation_prompts"])
+
+    return test_generation_batch(
+        model, tok, prefixes, consistency_texts, essence_texts, vec, edits=edits
+    )
+
+
+def compute_rewrite_scores_counterfact(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    records: typing.List[typing.Dict],
+    batch_tokens: int = 2048,
+    activation_cache=None,
+    edits: typing.Optional[typing.List[typing.Dict]] = None,
+) -> typing.List[typing.Dict]:
+    """
+    Computes the probability metrics of `compute_rewrite_quality_counterfact`
+    for several records at once, all against the same model: the prompts of
+    all records are scored together, in token-budgeted batches.
+
+    :param edits: If given, the edit set of each record, applied to the
+        prompts of that record only, as in `compute_generation_counterfact`.
+    """
+
+    keys = [
+        "rewrite_prompts",
+        "paraphrase_prompts",
+        "neighborhood_prompts",
+        "attribute_prompts",
+    ]
+    queries, query_edits, layouts = [], [], []
+    for r, record in enumerate(records):
+        # First, unpack rewrite evaluation record.
+        subject, target_new, target_true = (
+            record["requested_rewrite"][x]
+            for x in ["subject", "target_new", "target_true"]
+        )
+        # Form a list of lists of prefixes to test.
+        prob_prompts = [
+            [record["requested_rewrite"]["prompt"].format(subject)],
+            record["paraphrase_prompts"],
+            record["neighborhood_prompts"],
+            record["attribute_prompts"],
+        ]
+        layouts.append(list(map(len, prob_prompts)))
+        queries.extend(
+            prediction_queries(
+                tok, list(chain(*prob_prompts)), target_new["str"], target_true["str"]
+            )
         )
-        ret.update(gen_stats)
+        query_edits += [r] * (len(queries) - len(query_edits))
 
+    results, _ = score_targets(
+        model,
+        tok,
+        queries,
+        batch_tokens=batch_tokens,
+        activation_cache=activation_cache,
+        edits=edits,
+        query_edits=query_edits if edits is not None else None,
+    )
+
+    ret, offset = [], 0
+    for layout in layouts:
+        probs = pair_results(results[offset : offset + 2 * sum(layout)])
+        offset += 2 * sum(layout)
+        # Unflatten the results again into a list of lists.
+        cutoffs = [0] + np.cumsum(layout).tolist()
+        ret.append(
+            {
+                f"{key}_probs": probs[cutoffs[i] : cutoffs[i + 1]]
+                for i, key in enumerate(keys)
+            }
+        )
     return ret
 
 
-def test_batch_prediction(
-    model,
+def prediction_queries(
     tok,
     prefixes: typing.List[str],
     target_new: str,
     target_true: str,
 ):
-    """ """
+    """
+    Queries for `score_targets`, scoring both targets after every prefix.
+    """
 
     prefix_lens = [len(n) for n in tok(prefixes)["input_ids"]]
-    prompt_tok = tok(
-        [
-            f"{prefix} {suffix}"
-            for prefix in prefixes
-            for suffix in [target_new, target_true]
-        ],
-        padding=True,
-        return_tensors="pt",
-    ).to("cuda")
-
     a_tok, b_tok = (tok(f" {n}")["input_ids"] for n in [target_new, target_true])
-    choice_a_len, choice_b_len = (len(n) for n in [a_tok, b_tok])
-
-    with torch.no_grad():
-        logits = model(**prompt_tok).logits
-
-    results = np.zeros((logits.size(0),), dtype=np.float32)
+    return [
+        (f"{prefix} {suffix}", prefix_len, suffix_tok)
+        for prefix, prefix_len in zip(prefixes, prefix_lens)
+        for suffix, suffix_tok in [(target_new, a_tok), (target_true, b_tok)]
+    ]
 
-    for i in range(logits.size(0)):
-        cur_len = choice_a_len if i % 2 == 0 else choice_b_len
-        for j in range(cur_len):
-            cur_tok = (a_tok if i % 2 == 0 else b_tok)[j]
-            results[i] += -torch.nn.functional.log_softmax(
-                logits[i, prefix_lens[i // 2] + j - 1, :], dim=0
-            )[cur_tok].item()
-        results[i] /= cur_len
 
+def pair_results(results):
     return [
         {"target_new": results[i].item(), "target_true": results[i + 1].item()}
         for i in range(0, len(results), 2)
     ]
 
 
+def test_batch_prediction(
+    model,
+    tok,
+    prefixes: typing.List[str],
+    target_new: str,
+    target_true: str,
+):
+    """
+    Returns the mean negative log-probabilities of target_new and of
+    target_true after each of the prefixes.
+    """
+
+    results, _ = score_targets(
+        model, tok, prediction_queries(tok, prefixes, target_new, target_true)
+    )
+    return pair_results(results)
+
+
 def test_generation(
     model,
     tok,
@@ -153,30 +224,72 @@ def test_generation(
     essence_texts: typing.List[str],
     vec: TfidfVectorizer,
 ):
-    gen_texts = generate_fast(
-        model,
-        tok,
-        prefixes,
-        n_gen_per_prompt=1,
-        max_out_len=100,
-    )
+    return test_generation_batch(
+        model, tok, [prefixes], [consistency_texts], [essence_texts], vec
+    )[0]
 
-    ngram_entropy = n_gram_entropy(gen_texts)
-    consistency_tfidf = tfidf_similarity(
-        " ".join(gen_texts), " ".join(consistency_texts), vec
-    )
 
-    ret = {
-        "ngram_entropy": ngram_entropy,
-        "reference_score": consistency_tfidf,
-        "text": gen_texts,
-    }
+def test_generation_batch(
+    model,
+    tok,
+    prefixes: typing.List[typing.List[str]],
+    consistency_texts: typing.List[typing.List[str]],
+    essence_texts: typing.List[typing.List[str]],
+    vec: TfidfVectorizer,
+    edits: typing.Optional[typing.List[typing.Dict]] = None,
+):
+    """
+    Runs `test_generation` for several groups of prompts, with one call to
+    generate_fast for all prompts and one batch for all essence perplexities.
+    If `edits` are given, edits[i] is applied to the rows of group i only.
+    """
+
+    def row_edits(rows):
+        if edits is None:
+            return nullcontext()
+        return RowwiseEdits(model, edits, rows)
+
+    owners = [i for i, group in enumerate(prefixes) for _ in group]
+    with row_edits(owners):
+        all_gen_texts = generate_fast(
+            model,
+            tok,
+            list(chain(*prefixes)),
+            n_gen_per_prompt=1,
+            max_out_len=100,
+        )
+
+    essence_owners = [i for i, texts in enumerate(essence_texts) if len(texts) > 0]
+    ppls = {}
+    if len(essence_owners) > 0:
+        with row_edits(essence_owners):
+            ppls = perplexity_batch(
+                model,
+                tok,
+                [" ".join(essence_texts[i]) for i in essence_owners],
+                max_input_length=100,
+            )
+        ppls = dict(zip(essence_owners, ppls))
+
+    rets = []
+    for i in range(len(prefixes)):
+        gen_texts = [t for t, owner in zip(all_gen_texts, owners) if owner == i]
+        ngram_entropy = n_gram_entropy(gen_texts)
+        consistency_tfidf = tfidf_similarity(
+            " ".join(gen_texts), " ".join(consistency_texts[i]), vec
+        )
 
-    if len(essence_texts) > 0:
-        ppl = perplexity(model, tok, " ".join(essence_texts), max_input_length=100)
-        ret.update({"essence_score": ppl, "essence_text": essence_texts})
+        ret = {
+            "ngram_entropy": ngram_entropy,
+            "reference_score": consistency_tfidf,
+            "text": gen_texts,
+        }
 
-    return ret
+        if i in ppls:
+            ret.update({"essence_score": ppls[i], "essence_text": essence_texts[i]})
+        rets.append(ret)
+
+    return rets
 
 
 def n_gram_entropy(gen_texts, agg="arith"):
@@ -0,0 +1,213 @@
+"""
+Batched scoring of target tokens, shared by the CounterFact and zsRE
+evaluations. Queries from any number of prompts (and records) are packed
+into token-budgeted batches, and the log-probabilities of all their target
+tokens are gathered with a single log_softmax per batch. Results stay on the
+device until every batch is done, so scoring costs one host sync in total.
+Duplicate queries are scored once.
+
+Queries of independently edited records can share batches on the unedited
+model, each under its own record's low-rank edits, through `RowwiseEdits`.
+"""
+
+import typing
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from rome import RowwiseEdits
+from rome.tok_dataset import token_budget_batches
+
+
+def score_targets(
+    model,
+    tok,
+    queries: typing.List[typing.Tuple[str, int, typing.List[int]]],
+    batch_tokens: int = 2048,
+    activation_cache=None,
+    edits: typing.Optional[typing.List[typing.Dict]] = None,
+    query_edits: typing.Optional[typing.List[int]] = None,
+) -> typing.Tuple[np.ndarray, typing.List[typing.List[bool]]]:
+    """
+    Scores the target tokens of each query (text, start, target_ids): text is
+    tokenized, and its tokens from position `start` on are expected to be
+    target_ids (when start is the length of the text, the target is the
+    token following it). Returns, per query, the mean negative log-likelihood
+    of its target tokens, and whether each of them is the argmax prediction.
+
+    :param batch_tokens: Maximum number of padded tokens in a forward pass.
+    :param activation_cache: An `ActivationCache`, through which the forward
+        passes resume from cached lower-layer states.
+    :param edits: Edit sets in the format of `EditOverlay.add`; `model`
+        should then be unedited.
+    :param query_edits: For each query, the index in `edits` of the edit set
+        it is scored under, or -1 to score it on the unedited model.
+    """
+
+    if len(queries) == 0:
+        return np.zeros(0, dtype=np.float32), []
+    if query_edits is None:
+        query_edits = [-1] * len(queries)
+
+    # Identical queries, e.g. neighborhood prompts shared by several records,
+    # are only scored once per edit set
+    unique = {}
+    inverse = [
+        unique.setdefault((text, start, tuple(target_ids), e), len(unique))
+        for (text, start, target_ids), e in zip(queries, query_edits)
+    ]
+    if len(unique) < len(queries):
+        mean_nll, correct = score_targets(
+            model,
+            tok,
+            [(t, s, list(ids)) for t, s, ids, _ in unique],
+            batch_tokens=batch_tokens,
+            activation_cache=activation_cache,
+            edits=edits,
+            query_edits=[e for _, _, _, e in unique],
+        )
+        return mean_nll[inverse], [list(correct[i]) for i in inverse]
+
+    def row_edits(rows):
+        if edits is None:
+            return nullcontext()
+        return RowwiseEdits(model, edits, rows)
+
+    input_ids = tok([text for text, _, _ in queries])["input_ids"]
+    lengths = [len(x) for x in input_ids]
+    device = next(model.parameters()).device
+    pad_id = tok.pad_token_id if tok.pad_token_id is not None else tok.eos_token_id
+
+    nlls, corrects, owners = [], [], []
+    for batch in token_budget_batches(lengths, batch_tokens):
+        ids = torch.full((len(batch), lengths[batch[0]]), pad_id, dtype=torch.long)
+        mask = torch.zeros_like(ids)
+        rows, cols, targets = [], [], []
+        for row, i in enumerate(batch):
+            ids[row, : lengths[i]] = torch.tensor(input_ids[i])
+            mask[row, : lengths[i]] = 1
+            _, start, target_ids = queries[i]
+            for j, target in enumerate(target_ids):
+                # Logits at each position predict the following token
+                rows.append(row)
+                cols.append(start + j - 1)
+                targets.append(target)
+                owners.append(i)
+
+        with torch.no_grad(), row_edits([query_edits[i] for i in batch]):
+            ids, mask = ids.to(device), mask.to(device)
+            if activation_cache is None:
+                logits = model(input_ids=ids, attention_mask=mask).logits
+            else:
+                logits = activation_cache.logits(model, ids, mask)
+            selected = logits[rows, cols].float()
+            targets = torch.tensor(targets, device=device)
+            nlls.append(
+                -torch.log_softmax(selected, dim=1).gather(1, targets[:, None])[:, 0]
+            )
+            corrects.append(selected.argmax(dim=1) == targets)
+
+    assert len(owners) == sum(len(q[2]) for q in queries), "Empty prompt to score"
+    nll, correct = torch.cat(nlls).cpu().numpy(), torch.cat(corrects).cpu().numpy()
+
+    # Reduce per query; owners index the query of every scored token
+    owners = np.asarray(owners, dtype=np.int64)
+    counts = np.bincount(owners, minlength=len(queries))
+    mean_nll = np.zeros(len(queries), dtype=np.float32)
+    np.add.at(mean_nll, owners, nll)
+    mean_nll /= np.maximum(counts, 1)
+
+    order = np.argsort(owners, kind="stable")
+    splits = np.split(correct[order], np.cumsum(counts)[:-1])
+    return mean_nll, [x.tolist() for x in splits]
+
+
+# Unit Tests
+def _unit_test():
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    from rome.rome_main import upd_matrix_match_shape
+    from util import nethook
+
+    words = "[PAD] The Eiffel Tower is in Rome Paris Danielle Darrieux speaks English a"
+    vocab = {w: i for i, w in enumerate(words.split())}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[PAD]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tok = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]")
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(
+            n_layer=4, n_embd=32, n_head=4, n_positions=32, vocab_size=len(vocab)
+        )
+    ).eval()
+    w_name = "transformer.h.2.mlp.c_proj.weight"
+    edits = [
+        {w_name: (torch.randn(128), torch.randn(32))},
+        {w_name: (torch.randn(128, 2) / 4, torch.randn(32, 2))},
+    ]
+
+    def idx(text):
+        return [vocab[w] for w in text.split()]
+
+    texts = [
+        "The Eiffel Tower is in Rome",
+        "Danielle Darrieux speaks English",
+        "a Paris",
+        "The Eiffel Tower is in",
+        "Paris is in Rome a Paris Danielle Darrieux speaks English",
+    ]
+    queries = [
+        (texts[0], 5, idx("Rome")),
+        (texts[1], 2, idx("Darrieux speaks English")),
+        (texts[2], 1, idx("Paris")),
+        (texts[3], 5, idx("Rome")),
+        (texts[4], 3, idx("Rome a Paris Danielle")),
+    ]
+    # Duplicates, under the same and under different edit sets
+    queries += [queries[1], queries[4], queries[0], queries[1]]
+    query_edits = [0, 1, -1, 1, 0, 1, 0, 1, 0]
+
+    def per_token(query, edit):
+        # Reference: one forward per query, one log_softmax per target token
+        text, start, target_ids = query
+        w = nethook.get_parameter(model, w_name)
+        delta = torch.zeros_like(w)
+        if edit >= 0:
+            u, v = (x.view(len(x), -1) for x in edits[edit][w_name])
+            delta = upd_matrix_match_shape(u @ v.T, w.shape)
+        w.add_(delta)
+        logits = model(input_ids=torch.tensor([idx(text)])).logits[0]
+        w.sub_(delta)
+        nlls, correct = [], []
+        for j, target in enumerate(target_ids):
+            log_probs = torch.log_softmax(logits[start + j - 1], dim=0)
+            nlls.append(-log_probs[target].item())
+            correct.append(log_probs.argmax().item() == target)
+        return np.mean(nlls), correct
+
+    with torch.no_grad():
+        for batch_tokens in [16, 2048]:
+            for kwargs in [{}, dict(edits=edits, query_edits=query_edits)]:
+                mean_nll, correct = score_targets(
+                    model, tok, queries, batch_tokens=batch_tokens, **kwargs
+                )
+                for i, query in enumerate(queries):
+                    nll, expected = per_token(query, query_edits[i] if kwargs else -1)
+                    err = abs(mean_nll[i] - nll)
+                    assert err < 1e-4, (batch_tokens, kwargs.keys(), i, err)
+                    assert correct[i] == expected, (i, correct[i], expected)
+                print(f"batch_tokens={batch_tokens}, edits={bool(kwargs)}: OK")
+
+        # Edit sets change the scores of the queries they apply to
+        assert abs(score_targets(model, tok, queries[:1])[0][0] - mean_nll[0]) > 1e-3
+        mean_nll, correct = score_targets(model, tok, [])
+        assert len(mean_nll) == 0 and correct == []
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
@@ -5,14 +5,13 @@ appropriate arguments, which returns a dictionary containing them.
 """
 
 import typing
-from itertools import chain
 
 import numpy as np
-import torch
 from sklearn.feature_extraction.text import TfidfVectorizer
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from dsets import AttributeSnippets
+from experiments.py.eval_utils_scoring import score_targets
 
 
 def compute_rewrite_quality_zsre(
@@ -21,6 +20,8 @@ def compute_rewrite_quality_zsre(
     record: typing.Dict,
     snips: AttributeSnippets,
     vec: TfidfVectorizer,
+    scores: typing.Optional[typing.Dict] = None,
+    activation_cache=None,
 ) -> typing.Dict:
     """
     Given a rewritten model, computes generalization and specificity metrics for
@@ -32,89 +33,124 @@ def compute_rewrite_quality_zsre(
     :param record: CounterFact dataset record
     :paran snips: ???
     :param vec: ???
+    :param scores: This record's output of `compute_rewrite_scores_zsre`,
+        if already computed along with other records.
+    :param activation_cache: An `ActivationCache` below the edited layer, from
+        which the forward passes resume.
     :return: Dictionary containing rewriting metrics
     """
 
-    # First, unpack rewrite evaluation record.
-    subject, target_new, target_true = (
-        record["requested_rewrite"][x] for x in ["subject", "target_new", "target_true"]
-    )
-    rewrite_prompts = [record["requested_rewrite"]["prompt"].format(subject)]
-    paraphrase_prompts = record["paraphrase_prompts"]
-    neighborhood_prompts = record["neighborhood_prompts"]
-
-    # Form a list of lists of prefixes to test.
-    prob_prompts = [
-        rewrite_prompts,
-        paraphrase_prompts,
-    ]
-    # Flatten all the evaluated prefixes into one list.
-    target_tok = tok(" " + target_new["str"])["input_ids"]
-    inp_prompts_og = list(chain(*prob_prompts))
-    inp_prompts = [
-        el + tok.decode(target_tok[:i])
-        for el in inp_prompts_og
-        for i in range(len(target_tok))
-    ]
-    inp_targets = [
-        tok.decode(target_tok[i])
-        for _ in range(len(inp_prompts_og))
-        for i in range(len(target_tok))
-    ]
-
-    stuff_probs = test_batch_prediction_acc(model, tok, inp_prompts, inp_targets)
-
-    # Predict for neighborhood prompts (dictionary format).
-    neighborhood_correct = test_batch_prediction_acc(
-        model,
-        tok,
-        [
-            el["prompt"].format(record["requested_rewrite"])
-            for el in neighborhood_prompts
-        ],
-        [el["target"] for el in neighborhood_prompts],
-    )
+    if scores is None:
+        scores = compute_rewrite_scores_zsre(
+            model, tok, [record], activation_cache=activation_cache
+        )[0]
+    return dict(scores)
 
-    probs = stuff_probs + neighborhood_correct
-
-    # Unflatten the results again into a list of lists.
-    cutoffs = [0] + np.cumsum(
-        [l * len(target_tok) for l in map(len, prob_prompts)]
-    ).tolist()
-    ret_probs = [probs[cutoffs[i - 1] : cutoffs[i]] for i in range(1, len(cutoffs))]
-    # Structure the restuls as a dictionary.
-    ret = {
-        f"{key}_correct": ret_probs[i]
-        for i, key in enumerate(
+
+def compute_rewrite_scores_zsre(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    records: typing.List[typing.Dict],
+    batch_tokens: int = 2048,
+    activation_cache=None,
+    edits: typing.Optional[typing.List[typing.Dict]] = None,
+) -> typing.List[typing.Dict]:
+    """
+    Computes the metrics of `compute_rewrite_quality_zsre` for several records
+    at once, all against the same model: the prompts of all records are
+    scored together, in token-budgeted batches.
+
+    :param edits: If given, the edit set of each record, in the format of
+        `EditOverlay.add`, applied to the prompts of that record only;
+        `model` should then be unedited.
+    """
+
+    prompts, targets, prompt_edits, layouts = [], [], [], []
+    for r, record in enumerate(records):
+        # First, unpack rewrite evaluation record.
+        subject, target_new = (
+            record["requested_rewrite"][x] for x in ["subject", "target_new"]
+        )
+        rewrite_prompts = [record["requested_rewrite"]["prompt"].format(subject)]
+        paraphrase_prompts = record["paraphrase_prompts"]
+        neighborhood_prompts = record["neighborhood_prompts"]
+
+        # Each prefix of the target is a prompt for its next token.
+        target_tok = tok(" " + target_new["str"])["input_ids"]
+        for el in rewrite_prompts + paraphrase_prompts:
+            for i in range(len(target_tok)):
+                prompts.append(el + tok.decode(target_tok[:i]))
+                targets.append(tok.decode(target_tok[i]))
+        # Neighborhood prompts (dictionary format).
+        for el in neighborhood_prompts:
+            prompts.append(el["prompt"].format(record["requested_rewrite"]))
+            targets.append(el["target"])
+        prompt_edits += [r] * (len(prompts) - len(prompt_edits))
+        layouts.append(
             [
-                "rewrite_prompts",
-                "paraphrase_prompts",
+                len(rewrite_prompts) * len(target_tok),
+                len(paraphrase_prompts) * len(target_tok),
+                len(neighborhood_prompts),
             ]
         )
-    }
-    ret["neighborhood_prompts_correct"] = neighborhood_correct
 
+    correct = test_batch_prediction_acc(
+        model,
+        tok,
+        prompts,
+        targets,
+        batch_tokens=batch_tokens,
+        activation_cache=activation_cache,
+        edits=edits,
+        prompt_edits=prompt_edits if edits is not None else None,
+    )
+
+    ret, offset = [], 0
+    for layout in layouts:
+        cutoffs = offset + np.cumsum([0] + layout)
+        ret.append(
+            {
+                f"{key}_correct": correct[cutoffs[i] : cutoffs[i + 1]]
+                for i, key in enumerate(
+                    [
+                        "rewrite_prompts",
+                        "paraphrase_prompts",
+                        "neighborhood_prompts",
+                    ]
+                )
+            }
+        )
+        offset = cutoffs[-1]
     return ret
 
 
-def test_batch_prediction_acc(model, tok, prompts: typing.List[str], target):
-    prompt_tok = tok(
-        prompts,
-        padding=True,
-        return_tensors="pt",
-    ).to("cuda")
-
-    with torch.no_grad():
-        logits = model(**prompt_tok).logits
-        last_non_masked = prompt_tok["attention_mask"].sum(1) - 1
-        to_gather = last_non_masked.unsqueeze(1).repeat(1, logits.size(-1)).unsqueeze(1)
-        gathered = torch.gather(logits, 1, to_gather).squeeze(1)
-        ans = torch.argmax(gathered, dim=1)
-
-        correct_id = tok(target, padding=True, return_tensors="pt").to("cuda")[
-            "input_ids"
-        ]
-        # Temporary hack to deal with foreign characters.
-        correct_id = correct_id[:, 0].squeeze()
-
-        return (ans == correct_id).detach().cpu().numpy().tolist()
+def test_batch_prediction_acc(
+    model,
+    tok,
+    prompts: typing.List[str],
+    target,
+    batch_tokens: int = 2048,
+    activation_cache=None,
+    edits: typing.Optional[typing.List[typing.Dict]] = None,
+    prompt_edits: typing.Optional[typing.List[int]] = None,
+):
+    """
+    Returns whether the model's top prediction after each prompt is the
+    first token of the corresponding target. Prompts may be scored under
+    their own edit sets, as `query_edits` of `score_targets`.
+    """
+
+    prompt_lens = [len(n) for n in tok(prompts)["input_ids"]]
+    # Temporary hack to deal with foreign characters.
+    correct_id = [n[0] for n in tok(target)["input_ids"]]
+
+    _, correct = score_targets(
+        model,
+        tok,
+        [(p, n, [c]) for p, n, c in zip(prompts, prompt_lens, correct_id)],
+        batch_tokens=batch_tokens,
+        activation_cache=activation_cache,
+        edits=edits,
+        query_edits=prompt_edits,
+    )
+    return [c[0] for c in correct]
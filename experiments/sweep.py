@@ -22,6 +22,7 @@ def main(
     num_records: int,
     skip_generation_tests: bool,
     parallel_id: str,
+    regenerate_context_templates: bool = False,
 ):
     # Get current parameters
     with open(HPARAMS_DIR / alg_name / hparams_fname, "r") as f:
@@ -33,7 +34,7 @@ def main(
 
     # Execute sweep
     tmp_params_path = HPARAMS_DIR / alg_name / TMP_PARAMS_NAME.format(parallel_id)
-    for val in sweep_vals:
+    for i, val in enumerate(sweep_vals):
         data[sweep_key] = val
         with open(tmp_params_path, "w") as f:
             json.dump(data, f)
@@ -47,6 +48,8 @@ def main(
             skip_generation_tests=skip_generation_tests,
             conserve_memory=False,
             dir_name=f"{alg_name}_{sweep_key}_sweep_{parallel_id}",
+            # Templates only need to be sampled once per sweep
+            regenerate_context_templates=regenerate_context_templates and i == 0,
         )
 
     os.remove(tmp_params_path)
@@ -70,6 +73,11 @@ if __name__ == "__main__":
         "--use_generation_tests", dest="skip_generation_tests", action="store_false"
     )
     parser.set_defaults(skip_generation_tests=True)
+    parser.add_argument(
+        "--regenerate_context_templates",
+        dest="regenerate_context_templates",
+        action="store_true",
+    )
     # Must be unique to prevent conflicts when simultaenously running multiple sweeps
     parser.add_argument("--parallel_id", type=str, required=True)
 
@@ -92,4 +100,5 @@ if __name__ == "__main__":
         args.num_records,
         args.skip_generation_tests,
         args.parallel_id,
+        regenerate_context_templates=args.regenerate_context_templates,
     )
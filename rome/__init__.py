@@ -1 +1,9 @@
-from .rome_main import ROMEHyperParams, apply_rome_to_model, execute_rome
+from .rome_main import (
+    ROMEHyperParams,
+    apply_rome_to_model,
+    execute_rome,
+    execute_rome_batch,
+    execute_rome_joint,
+    get_context_templates,
+)
+from .edit_overlay import EditOverlay, RowwiseEdits
@@ -1,58 +1,234 @@
 import os
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from rome import repr_tools
 from util.globals import *
+from util.runningstats import LowRankSecondMoment, load_cached_state, save_cached_state
 
-from .layer_stats import layer_stats
+from .layer_stats import layer_stats, layer_stats_file_extension, local_corpus_ds_name
 from .rome_hparams import ROMEHyperParams
 
 # Cache variables
-inv_mom2_cache = {}
+mom2_factor_cache = {}
 
 
-def get_inv_cov(
+class CovFactor:
+    """
+    Factorization of a second moment matrix C, used to apply C^-1 without
+    ever forming the inverse. Either a Cholesky factor (C = L L^T), applied
+    with triangular solves, or an eigendecomposition (C = Q diag(s) Q^T),
+    which lets any Tikhonov regularization be applied without refactoring.
+    Factors are computed in float64 and stored in float32.
+
+    For very wide layers, a "sketch" replaces C by the low-rank-plus-diagonal
+    approximation V diag(lam) V^T + diag(res) of a LowRankSecondMoment,
+    which is applied with the Woodbury identity. Its effect on ROME edits
+    has not been measured (see experiments/cov_sketch_accuracy.py).
+    """
+
+    def __init__(self, kind: str, factors: Dict[str, torch.Tensor], reg: float = 0.0):
+        assert kind in {"cholesky", "eigh", "sketch"}, f"Unknown factorization {kind}"
+        self.kind = kind
+        self.factors = factors
+        self.reg = reg
+
+    @classmethod
+    def from_moment(cls, mom2: torch.Tensor, kind: str, reg: float = 0.0):
+        """
+        Factorizes the second moment `mom2`. For Cholesky factors, the
+        regularization is applied before factoring; eigendecompositions are
+        always of the unregularized matrix.
+        """
+
+        mom2 = mom2.double()
+        if kind == "cholesky":
+            mom2 = mom2 + reg * mean_eigenvalue(mom2) * torch.eye(
+                len(mom2), dtype=mom2.dtype, device=mom2.device
+            )
+            factors = dict(L=torch.linalg.cholesky(mom2).float())
+        elif kind == "eigh":
+            s, Q = torch.linalg.eigh(mom2)
+            factors = dict(s=s.float(), Q=Q.float())
+            reg = 0.0
+        else:
+            raise ValueError(f"Unknown factorization {kind}")
+
+        return cls(kind, factors, reg=reg)
+
+    @classmethod
+    def from_sketch(cls, sketch: LowRankSecondMoment):
+        V, lam, res = sketch.factors()
+        return cls("sketch", dict(V=V.float(), lam=lam.float(), res=res.float()))
+
+    def solve(self, k: torch.Tensor, reg: float = 0.0) -> torch.Tensor:
+        """
+        Returns (C + reg * mean_eig(C) * I)^-1 k, for k of shape [d] or [d, n].
+        Cholesky factors only support the regularization they were built with.
+        """
+
+        squeeze = k.dim() == 1
+        k = k.unsqueeze(1) if squeeze else k
+        if self.kind == "cholesky":
+            assert reg == self.reg, "Cholesky factor built with a different reg"
+            ret = torch.cholesky_solve(k.to(self.factors["L"].dtype), self.factors["L"])
+        elif self.kind == "sketch":
+            ret = LowRankSecondMoment.woodbury_solve(
+                self.factors["V"], self.factors["lam"], self.factors["res"], k, reg=reg
+            )
+        else:
+            s, Q = self.factors["s"], self.factors["Q"]
+            ret = Q @ ((Q.T @ k.to(Q.dtype)) / (s + reg * s.mean()).unsqueeze(1))
+
+        return ret.squeeze(1) if squeeze else ret
+
+    def to_(self, device):
+        self.factors = {k: v.to(device) for k, v in self.factors.items()}
+        return self
+
+    def state_dict(self):
+        return dict(
+            kind=self.kind,
+            reg=self.reg,
+            **{k: v.cpu().numpy() for k, v in self.factors.items()},
+        )
+
+    @classmethod
+    def from_state_dict(cls, state):
+        factors = {
+            k: torch.from_numpy(state[k])
+            for k in state.keys()
+            if k not in {"kind", "reg"}
+        }
+        return cls(str(state["kind"]), factors, reg=float(state["reg"]))
+
+
+def mean_eigenvalue(mom2: torch.Tensor) -> torch.Tensor:
+    return mom2.diagonal().mean()
+
+
+def get_cov_factor(
     model: AutoModelForCausalLM,
     tok: AutoTokenizer,
     layer_name: str,
     mom2_dataset: str,
     mom2_n_samples: str,
     mom2_dtype: str,
-) -> torch.Tensor:
+    kind: str = "cholesky",
+    reg: float = 0.0,
+    sketch_rank: int = 256,
+    local_corpus: Optional[str] = None,
+) -> CovFactor:
     """
-    Retrieves covariance statistics, then computes the algebraic inverse.
-    Caches result for future use.
+    Retrieves covariance statistics, then factorizes them. The factor is
+    cached in memory and persisted next to the statistics file, so it is
+    only computed once per (model, layer). Like the statistics, it is stored
+    memory-mapped, so processes on the same host share one copy of it.
+
+    With kind="sketch", a rank-`sketch_rank` LowRankSecondMoment is collected
+    instead of the dense second moment, which is never formed.
+
+    If `local_corpus` is given, the statistics are sampled from that text or
+    JSONL file (or directory) instead of `mom2_dataset`, and cached under a
+    name derived from its path.
     """
 
-    global inv_mom2_cache
+    global mom2_factor_cache
 
+    if local_corpus is not None:
+        mom2_dataset = local_corpus_ds_name(local_corpus)
     model_name = model.config._name_or_path.replace("/", "_")
-    key = (model_name, layer_name)
+    # Eigendecompositions and sketches do not depend on the regularization
+    key = (
+        model_name,
+        layer_name,
+        mom2_dataset,
+        kind,
+        reg if kind == "cholesky" else None,
+        sketch_rank if kind == "sketch" else None,
+    )
+    to_collect = [f"sketch{sketch_rank}"] if kind == "sketch" else ["mom2"]
 
-    if key not in inv_mom2_cache:
+    if key not in mom2_factor_cache:
+        if kind == "sketch":
+            print(
+                "WARNING: the accuracy of covariance sketches for ROME has not been "
+                "measured on real models, and on synthetic data the sketched u "
+                "deviates noticeably from the dense one. Check it with "
+                "experiments/cov_sketch_accuracy.py before relying on it."
+            )
         print(
-            f"Retrieving inverse covariance statistics for {model_name} @ {layer_name}. "
+            f"Retrieving {kind} factor of covariance statistics for {model_name} @ {layer_name}. "
             f"The result will be cached to avoid repetitive computation."
         )
-        stat = layer_stats(
+        stats_file = STATS_DIR / layer_stats_file_extension(
             model,
-            tok,
             layer_name,
-            STATS_DIR,
             mom2_dataset,
-            to_collect=["mom2"],
+            to_collect,
             sample_size=mom2_n_samples,
             precision=mom2_dtype,
         )
-        inv_mom2_cache[key] = torch.inverse(
-            stat.mom2.moment().to("cuda")
-        ).float()  # Cast back to float32
+        reg_suffix = f"_reg{reg}" if kind == "cholesky" and reg != 0 else ""
+        factor_file = stats_file.with_name(f"{stats_file.stem}_{kind}{reg_suffix}.npz")
+
+        factor_state = load_cached_state(factor_file, {}, quiet=True)
+        if factor_state is not None:
+            print(f"Loading cached factor {factor_file}")
+            factor = CovFactor.from_state_dict(factor_state)
+        else:
+            stat = layer_stats(
+                model,
+                tok,
+                layer_name,
+                STATS_DIR,
+                mom2_dataset,
+                to_collect=to_collect,
+                sample_size=mom2_n_samples,
+                precision=mom2_dtype,
+                local_corpus=local_corpus,
+            )
+            if kind == "sketch":
+                factor = CovFactor.from_sketch(getattr(stat, to_collect[0]))
+            else:
+                factor = CovFactor.from_moment(
+                    stat.mom2.moment().to(next(model.parameters()).device), kind, reg
+                )
+            save_cached_state(factor_file, factor, {})
+
+        mom2_factor_cache[key] = factor.to_(next(model.parameters()).device)
 
-    return inv_mom2_cache[key]
+    return mom2_factor_cache[key]
+
+
+def apply_inv_cov(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    hparams: ROMEHyperParams,
+    layer: int,
+    k: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Applies the inverse second moment of the rewrite module's keys at `layer`
+    to k, which may be a single key [d] or a matrix of keys [d, n].
+    """
+
+    return get_cov_factor(
+        model,
+        tok,
+        hparams.rewrite_module_tmp.format(layer),
+        hparams.mom2_dataset,
+        hparams.mom2_n_samples,
+        hparams.mom2_dtype,
+        kind=hparams.mom2_factor,
+        reg=hparams.mom2_reg,
+        sketch_rank=hparams.mom2_sketch_rank,
+        local_corpus=hparams.mom2_local_corpus,
+    ).solve(k, reg=hparams.mom2_reg)
 
 
 def compute_u(
@@ -62,6 +238,7 @@ def compute_u(
     hparams: ROMEHyperParams,
     layer: int,
     context_templates: List[str],
+    template_reprs: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
 ) -> torch.Tensor:
     """
     Computes the right vector used in constructing the rank-1 update matrix.
@@ -69,6 +246,41 @@ def compute_u(
 
     print("Computing left vector (u)...")
 
+    cur_repr = compute_key(
+        model,
+        tok,
+        request,
+        hparams,
+        layer,
+        context_templates,
+        template_reprs=template_reprs,
+    )
+
+    # Apply inverse second moment adjustment
+    u = cur_repr
+    if hparams.mom2_adjustment:
+        u = apply_inv_cov(model, tok, hparams, layer, u)
+
+    return u / u.norm()
+
+
+def compute_key(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    request: Dict,
+    hparams: ROMEHyperParams,
+    layer: int,
+    context_templates: List[str],
+    template_reprs: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+) -> torch.Tensor:
+    """
+    Computes the key of the request's subject at the input of the rewrite
+    module, before the inverse second moment adjustment.
+
+    :param template_reprs: Output of `compute_v.get_template_reprs` for the
+        request, if already computed. Its inputs are the keys averaged here.
+    """
+
     # Compute projection token
     word_repr_args = dict(
         model=model,
@@ -80,7 +292,9 @@ def compute_u(
     if "subject_" in hparams.fact_token and hparams.fact_token.index("subject_") == 0:
         word = request["subject"]
         print(f"Selected u projection object {word}")
-        if hparams.original_implementation or hparams.enable_random_prefix_keys:
+        if template_reprs is not None:
+            cur_repr = template_reprs[0].mean(0)
+        elif hparams.original_implementation or hparams.enable_random_prefix_keys:
             cur_repr = repr_tools.get_reprs_at_word_tokens(
                 context_templates=[
                     templ.format(request["prompt"]) for templ in context_templates
@@ -104,29 +318,21 @@ def compute_u(
         # Heuristic to choose last word. Not a huge deal if there's a minor
         # edge case (e.g. multi-token word) because the function below will
         # take the last token.
-        cur_repr = repr_tools.get_reprs_at_idxs(
-            contexts=[
+        if template_reprs is not None:
+            cur_repr = template_reprs[0].mean(0)
+        else:
+            contexts = [
                 templ.format(request["prompt"].format(request["subject"]))
                 for templ in context_templates
-            ],
-            idxs=[[-1] for _ in range(len(context_templates))],
-            **word_repr_args,
-        ).mean(0)
+            ]
+            # Contexts are right-padded into one batch; take each one's last token
+            cur_repr = repr_tools.get_reprs_at_idxs(
+                contexts=contexts,
+                idxs=[[len(ids) - 1] for ids in tok(contexts)["input_ids"]],
+                **word_repr_args,
+            ).mean(0)
         print("Selected u projection token with last token")
     else:
         raise ValueError(f"fact_token={hparams.fact_token} not recognized")
 
-    # Apply inverse second moment adjustment
-    u = cur_repr
-    if hparams.mom2_adjustment:
-        u = get_inv_cov(
-            model,
-            tok,
-            hparams.rewrite_module_tmp.format(layer),
-            hparams.mom2_dataset,
-            hparams.mom2_n_samples,
-            hparams.mom2_dtype,
-        ) @ u.unsqueeze(1)
-        u = u.squeeze()
-
-    return u / u.norm()
+    return cur_repr
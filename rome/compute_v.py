@@ -1,4 +1,4 @@
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -7,6 +7,12 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from rome import repr_tools
 from util import nethook
+from util.partial_forward import (
+    BlockInputs,
+    capture_block_inputs,
+    forward_from_block,
+    hidden_to_logits,
+)
 
 from .rome_hparams import ROMEHyperParams
 
@@ -19,60 +25,174 @@ def compute_v(
     layer: int,
     left_vector: torch.Tensor,
     context_templates: List[str],
+    template_reprs: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
 ) -> torch.Tensor:
     """
     Computes the value (right) vector for the rank-1 update.
     Runs a simple optimization procedure.
     """
 
+    return compute_vs(
+        model,
+        tok,
+        [request],
+        hparams,
+        layer,
+        [left_vector],
+        context_templates,
+        all_template_reprs=[template_reprs],
+    )[0]
+
+
+def compute_vs(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    requests: List[Dict],
+    hparams: ROMEHyperParams,
+    layer: int,
+    left_vectors: List[torch.Tensor],
+    context_templates: List[str],
+    all_template_reprs: Optional[List] = None,
+) -> List[torch.Tensor]:
+    """
+    Computes the value (right) vectors for the rank-1 updates of several
+    requests at once. The v* optimizations of all requests share a single
+    batch of prompts, but each request has its own delta, loss, early stopping
+    and norm clamping, so the result is the same as running `compute_v`
+    separately for each request against the same model.
+
+    :param all_template_reprs: Outputs of `get_template_reprs`, one per
+        request, if already computed.
+    """
+
     print("Computing right vector (v)")
 
-    # Tokenize target into list of int token IDs
-    target_ids = tok(request["target_new"]["str"], return_tensors="pt").to("cuda")[
-        "input_ids"
-    ][0]
+    deltas, target_inits = optimize_v_deltas(
+        model, tok, requests, hparams, layer, context_templates
+    )
+
+    if all_template_reprs is None:
+        all_template_reprs = [None for _ in requests]
 
-    # Compile list of rewriting and KL x/y pairs
+    right_vectors = []
+    for request, left_vector, delta, target_init, template_reprs in zip(
+        requests, left_vectors, deltas, target_inits, all_template_reprs
+    ):
+        cur_input, cur_output, target = get_v_targets(
+            model,
+            tok,
+            request,
+            hparams,
+            layer,
+            context_templates,
+            delta,
+            target_init,
+            template_reprs=template_reprs,
+        )
+
+        # Solving the linear system to compute the right vector
+        right_vector = (target - cur_output) / torch.dot(cur_input, left_vector)
+        print(f"Delta norm: {(target - cur_output).norm().item()}")
+        print(
+            f"Change in target norm: {target_init.norm().item()} to {target.norm().item()} => {(target.norm() - target_init.norm()).item()}"
+        )
+        print(f"Division Factor: {torch.dot(cur_input, left_vector).item()}")
+        print(f"Right vector norm: {right_vector.norm()}")
+        right_vectors.append(right_vector)
+
+    return right_vectors
+
+
+def optimize_v_deltas(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    requests: List[Dict],
+    hparams: ROMEHyperParams,
+    layer: int,
+    context_templates: List[str],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Runs the v* optimization for every request in `requests` jointly.
+    Returns the optimized deltas and the initial values of v*, both of shape
+    [len(requests), n_embd].
+    """
+
+    device = next(model.parameters()).device
+    n_req, n_ctx = len(requests), len(context_templates)
+
+    # Tokenize targets into lists of int token IDs
+    target_ids = [
+        tok(request["target_new"]["str"], return_tensors="pt").to(device)["input_ids"][
+            0
+        ]
+        for request in requests
+    ]
+
+    # Compile list of rewriting and KL x/y pairs. Rewriting prompts of all
+    # requests come first, followed by one KL prompt per request.
     rewriting_prompts, kl_prompts = (
         [
-            context.format(request["prompt"]) + tok.decode(target_ids[:-1])
+            context.format(request["prompt"]) + tok.decode(target_ids[r][:-1])
+            for r, request in enumerate(requests)
             for context in context_templates
         ],
-        ["{} is a"],
+        ["{} is a" for _ in requests],
     )
     all_prompts = rewriting_prompts + kl_prompts
+    prompt_reqs = [r for r in range(n_req) for _ in range(n_ctx)] + list(range(n_req))
 
     input_tok = tok(
-        [prompt.format(request["subject"]) for prompt in all_prompts],
+        [
+            prompt.format(requests[prompt_reqs[i]]["subject"])
+            for i, prompt in enumerate(all_prompts)
+        ],
         return_tensors="pt",
         padding=True,
-    ).to("cuda")
+    ).to(device)
 
     # Compute rewriting targets
-    rewriting_targets = torch.tensor(-100, device="cuda").repeat(
+    rewriting_targets = torch.tensor(-100, device=device).repeat(
         len(rewriting_prompts), *input_tok["input_ids"].shape[1:]
     )
     for i in range(len(rewriting_prompts)):
         ex_len = input_tok["attention_mask"][i].sum()
-        rewriting_targets[i, ex_len - len(target_ids) : ex_len] = target_ids
+        cur_target_ids = target_ids[prompt_reqs[i]]
+        rewriting_targets[i, ex_len - len(cur_target_ids) : ex_len] = cur_target_ids
+    target_lens = torch.tensor([len(target_ids[r]) for r in range(n_req)]).to(device)
 
     # Compute indices of the tokens where the fact is looked up
     lookup_idxs = [
         find_fact_lookup_idx(
-            prompt, request["subject"], tok, hparams.fact_token, verbose=(i == 0)
+            prompt,
+            requests[prompt_reqs[i]]["subject"],
+            tok,
+            hparams.fact_token,
+            verbose=(i == 0),
         )
         for i, prompt in enumerate(all_prompts)
     ]
+    rows, lookup_cols, row_reqs = (
+        torch.arange(len(all_prompts), device=device),
+        torch.tensor(lookup_idxs, device=device),
+        torch.tensor(prompt_reqs, device=device),
+    )
+    # Row of each request's clean ("{}") rewriting prompt
+    init_rows = torch.arange(n_req, device=device) * n_ctx
+    kl_rows = rows[len(rewriting_prompts) :]
+    # Positions whose logits enter the NLL loss, and the tokens they predict
+    target_rows, target_cols = (rewriting_targets != -100).nonzero(as_tuple=True)
+    target_toks = rewriting_targets[target_rows, target_cols]
 
     # Finalize rewrite and loss layers
     loss_layer = max(hparams.v_loss_layer, layer)
     print(f"Rewrite layer is {layer}")
     print(f"Tying optimization objective to {loss_layer}")
 
-    # Set up an optimization over a latent vector that, when output at the
+    # Set up an optimization over latent vectors that, when output at the
     # rewrite layer, i.e. hypothesized fact lookup location, will induce the
-    # target token to be predicted at the final layer.
-    delta = torch.zeros((model.config.n_embd,), requires_grad=True, device="cuda")
+    # target tokens to be predicted at the final layer. Each request gets its
+    # own row of `delta`.
+    delta = torch.zeros((n_req, model.config.n_embd), requires_grad=True, device=device)
     target_init, kl_distr_init = None, None
 
     # Inserts new "delta" variable at the appropriate part of the computation
@@ -84,10 +204,11 @@ def compute_v(
             if target_init is None:
                 print("Recording initial value of v*")
                 # Initial value is recorded for the clean sentence
-                target_init = cur_out[0, lookup_idxs[0]].detach().clone()
+                target_init = (
+                    cur_out[init_rows, lookup_cols[init_rows]].detach().clone()
+                )
 
-            for i, idx in enumerate(lookup_idxs):
-                cur_out[i, idx, :] += delta
+            cur_out[rows, lookup_cols] += delta[row_reqs]
 
         return cur_out
 
@@ -95,6 +216,19 @@ def compute_v(
     opt = torch.optim.Adam([delta], lr=hparams.v_lr)
     nethook.set_requires_grad(False, model)
 
+    # Blocks below the rewrite layer are unaffected by delta, so their output
+    # can be computed once and each step can resume the forward pass from there.
+    block_inputs = None
+    if hparams.v_partial_forward:
+        with torch.no_grad():
+            block_inputs = capture_block_inputs(
+                model, hparams.layer_module_tmp, layer, **input_tok
+            )
+
+    target_desc = requests[0]["target_new"]["str"] if n_req == 1 else f"{n_req} targets"
+    # Requests whose optimization has converged; their deltas are frozen.
+    done = torch.zeros(n_req, dtype=torch.bool, device=device)
+
     # Execute optimization
     for it in range(hparams.v_num_grad_steps):
         opt.zero_grad()
@@ -110,81 +244,158 @@ def compute_v(
             retain_output=True,
             edit_output=edit_output_fn,
         ) as tr:
-            logits = model(**input_tok).logits
-
             # Compute distribution for KL divergence
-            kl_logits = torch.stack(
-                [
-                    logits[i - len(kl_prompts), idx, :]
-                    for i, idx in enumerate(lookup_idxs[-len(kl_prompts) :])
-                ],
-                dim=0,
-            )
+            if hparams.v_sparse_logits:
+                # Only the target and KL positions go through ln_f and lm_head
+                hidden = get_final_hidden(
+                    model, input_tok, hparams, layer, block_inputs
+                )
+                kl_logits = hidden_to_logits(
+                    model, hparams.ln_f_module, hidden[kl_rows, lookup_cols[kl_rows]]
+                )
+                target_logits = hidden_to_logits(
+                    model, hparams.ln_f_module, hidden[target_rows, target_cols]
+                )
+            else:
+                if block_inputs is not None:
+                    logits = forward_from_block(
+                        model,
+                        block_inputs,
+                        hparams.layer_module_tmp,
+                        layer,
+                        hparams.ln_f_module,
+                        checkpoint=hparams.v_checkpoint_blocks,
+                    )
+                else:
+                    logits = model(**input_tok).logits
+                kl_logits = logits[kl_rows, lookup_cols[kl_rows], :]
             kl_log_probs = torch.nn.functional.log_softmax(kl_logits, dim=1)
             if kl_distr_init is None:
                 kl_distr_init = kl_log_probs.detach().clone()
 
-        # Compute loss on rewriting targets
-        log_probs = torch.log_softmax(logits, dim=2)
-
-        loss = torch.gather(
-            log_probs,
-            2,
-            torch.where(rewriting_targets != -100, rewriting_targets, 0).unsqueeze(2),
-        ).squeeze(2)
-        mask = (rewriting_targets != -100).float()
-
-        # Aggregate total losses
-        nll_loss_each = -(loss * mask).sum(1) / target_ids.size(0)
-        nll_loss = nll_loss_each.mean()
-        kl_loss = hparams.kl_factor * torch.nn.functional.kl_div(
-            kl_distr_init, kl_log_probs, log_target=True, reduction="batchmean"
-        )
-        weight_decay = hparams.v_weight_decay * (
-            torch.norm(delta) / torch.norm(target_init) ** 2
-        )
-        # weight_decay = hparams.v_weight_decay * torch.norm(delta) ** 2
-        loss = nll_loss + kl_loss + weight_decay
-        print(
-            f"loss {np.round(loss.item(), 3)} = {np.round(nll_loss.item(), 3)} + {np.round(kl_loss.item(), 3)} + {np.round(weight_decay.item(), 3)} "
-            f"avg prob of [{request['target_new']['str']}] "
-            f"{torch.exp(-nll_loss_each).mean().item()}"
+            # Compute loss on rewriting targets
+            if hparams.v_sparse_logits:
+                target_log_probs = torch.gather(
+                    torch.log_softmax(target_logits, dim=1), 1, target_toks.unsqueeze(1)
+                ).squeeze(1)
+                loss_sum = torch.zeros(
+                    len(rewriting_prompts), dtype=target_log_probs.dtype, device=device
+                ).index_add(0, target_rows, target_log_probs)
+            else:
+                log_probs = torch.log_softmax(logits[: len(rewriting_prompts)], dim=2)
+
+                loss = torch.gather(
+                    log_probs,
+                    2,
+                    torch.where(
+                        rewriting_targets != -100, rewriting_targets, 0
+                    ).unsqueeze(2),
+                ).squeeze(2)
+                mask = (rewriting_targets != -100).float()
+                loss_sum = (loss * mask).sum(1)
+
+            # Aggregate total losses, separately for each request
+            nll_loss_each = -loss_sum / target_lens[row_reqs[: len(loss_sum)]]
+            nll_loss = nll_loss_each.view(n_req, n_ctx).mean(1)
+            kl_loss = hparams.kl_factor * (
+                kl_log_probs.exp() * (kl_log_probs - kl_distr_init)
+            ).sum(1)
+            weight_decay = hparams.v_weight_decay * (
+                torch.norm(delta, dim=1) / torch.norm(target_init, dim=1) ** 2
+            )
+            # weight_decay = hparams.v_weight_decay * torch.norm(delta) ** 2
+            loss = nll_loss + kl_loss + weight_decay
+            print(
+                f"loss {np.round(loss.mean().item(), 3)} = {np.round(nll_loss.mean().item(), 3)} + {np.round(kl_loss.mean().item(), 3)} + {np.round(weight_decay.mean().item(), 3)} "
+                f"avg prob of [{target_desc}] "
+                f"{torch.exp(-nll_loss_each).mean().item()}"
+            )
+            done |= loss < 5e-2
+            if done.all():
+                break
+
+            if it == hparams.v_num_grad_steps - 1:
+                break
+
+            # Backpropagate. Requests are independent, so the gradient of the sum
+            # is the gradient of each request's own loss. This happens while the
+            # hooks are in place, so checkpointed blocks recompute with delta.
+            torch.where(done, torch.zeros_like(loss), loss).sum().backward()
+        prev_delta = delta.detach().clone()
+        opt.step()
+
+        with torch.no_grad():
+            # Converged requests keep their delta, as if their loop had ended
+            delta[done] = prev_delta[done]
+
+            # Project within L2 ball
+            max_norm = hparams.clamp_norm_factor * target_init.norm(dim=1)
+            delta_norm = delta.norm(dim=1)
+            over = delta_norm > max_norm
+            delta[over] = delta[over] * (max_norm[over] / delta_norm[over]).unsqueeze(1)
+
+    return delta.detach(), target_init
+
+
+def get_final_hidden(
+    model: AutoModelForCausalLM,
+    input_tok: Dict,
+    hparams: ROMEHyperParams,
+    layer: int,
+    block_inputs: Optional[BlockInputs] = None,
+) -> torch.Tensor:
+    """
+    Returns the hidden states entering the final layer norm, without
+    computing logits. Resumes from `block_inputs` if given.
+    """
+
+    if block_inputs is not None:
+        return forward_from_block(
+            model,
+            block_inputs,
+            hparams.layer_module_tmp,
+            layer,
+            checkpoint=hparams.v_checkpoint_blocks,
         )
-        if loss < 5e-2:
-            break
 
-        if it == hparams.v_num_grad_steps - 1:
-            break
+    with nethook.Trace(
+        model, hparams.ln_f_module, retain_input=True, retain_output=False, stop=True
+    ) as tr:
+        model(**input_tok)
+    return tr.input
 
-        # Backpropagate
-        loss.backward()
-        opt.step()
 
-        # Project within L2 ball
-        max_norm = hparams.clamp_norm_factor * target_init.norm()
-        if delta.norm() > max_norm:
-            with torch.no_grad():
-                delta[...] = delta * max_norm / delta.norm()
+def get_v_targets(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    request: Dict,
+    hparams: ROMEHyperParams,
+    layer: int,
+    context_templates: List[str],
+    delta: torch.Tensor,
+    target_init: torch.Tensor,
+    template_reprs: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Given the optimized delta of a request, retrieves the key (cur_input) and
+    current value (cur_output) at the rewrite module, together with the value
+    the edited module should produce instead (target).
+
+    :param template_reprs: Output of `get_template_reprs` for the request, if
+        already computed.
+    """
 
     if hparams.enable_random_prefix_keys:
-        cur_inputs, cur_outputs = [], []
-        # run hook for all random prefixes
-        for context_template in context_templates:
-            cur_input, cur_output = get_module_input_output_at_word(
-                model,
-                tok,
-                layer,
-                context_template=context_template.format(request["prompt"]),
-                word=request["subject"],
-                module_template=hparams.rewrite_module_tmp,
-                fact_token_strategy=hparams.fact_token,
+        # run hook for all random prefixes at once, unless already done
+        if template_reprs is None:
+            template_reprs = get_template_reprs(
+                model, tok, request, hparams, layer, context_templates
             )
-            cur_inputs.append(cur_input)
-            cur_outputs.append(cur_output)
+        cur_inputs, cur_outputs = template_reprs
 
         # average the representations across prefixes
-        cur_input = torch.stack(cur_inputs).mean(0)
-        cur_output = torch.stack(cur_outputs).mean(0)
+        cur_input = cur_inputs.mean(0)
+        cur_output = cur_outputs.mean(0)
 
         # target_init is v*, based on output from random prefix computations
         target = target_init + delta
@@ -205,16 +416,7 @@ def compute_v(
         # cur_output is v, based on output from prompt-only computations
         target = cur_output + delta
 
-    # Solving the linear system to compute the right vector
-    right_vector = (target - cur_output) / torch.dot(cur_input, left_vector)
-    print(f"Delta norm: {(target - cur_output).norm().item()}")
-    print(
-        f"Change in target norm: {target_init.norm().item()} to {target.norm().item()} => {(target.norm() - target_init.norm()).item()}"
-    )
-    print(f"Division Factor: {torch.dot(cur_input, left_vector).item()}")
-    print(f"Right vector norm: {right_vector.norm()}")
-
-    return right_vector
+    return cur_input, cur_output, target
 
 
 def get_module_input_output_at_word(
@@ -231,6 +433,32 @@ def get_module_input_output_at_word(
     output of a particular layer module.
     """
 
+    l_input, l_output = get_module_input_output_at_words(
+        model,
+        tok,
+        layer,
+        context_templates=[context_template],
+        words=[word],
+        module_template=module_template,
+        fact_token_strategy=fact_token_strategy,
+    )
+    return l_input[0], l_output[0]
+
+
+def get_module_input_output_at_words(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    layer: int,
+    context_templates: List[str],
+    words: List[str],
+    module_template: str,
+    fact_token_strategy: str,
+) -> Tuple[torch.Tensor]:
+    """
+    Retrieves detached representations for each word at the input and
+    output of a particular layer module, for all templates in one batch.
+    """
+
     word_repr_args = dict(
         model=model,
         tok=tok,
@@ -242,24 +470,54 @@ def get_module_input_output_at_word(
         l_input, l_output = repr_tools.get_reprs_at_word_tokens(
             track="both",
             subtoken=subtoken,
-            context_templates=[context_template],
-            words=[word],
+            context_templates=context_templates,
+            words=words,
             **word_repr_args,
         )
     elif fact_token_strategy == "last":
+        contexts = [tmp.format(word) for tmp, word in zip(context_templates, words)]
+        # Contexts are right-padded into one batch; take each one's last token
         l_input, l_output = repr_tools.get_reprs_at_idxs(
             track="both",
-            contexts=[context_template.format(word)],
-            idxs=[[-1]],
+            contexts=contexts,
+            idxs=[[len(ids) - 1] for ids in tok(contexts)["input_ids"]],
             **word_repr_args,
         )
     else:
         raise ValueError(f"fact_token={fact_token_strategy} not recognized")
 
-    l_input, l_output = l_input[0], l_output[0]
     return l_input.detach(), l_output.detach()
 
 
+def get_template_reprs(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    request: Dict,
+    hparams: ROMEHyperParams,
+    layer: int,
+    context_templates: List[str],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Retrieves the input and output of the rewrite module at the fact token of
+    the request, for every context template, in a single forward pass. With
+    random prefix keys, both compute_u and compute_v average over these, so
+    they can share one extraction.
+    """
+
+    return get_module_input_output_at_words(
+        model,
+        tok,
+        layer,
+        context_templates=[
+            context_template.format(request["prompt"])
+            for context_template in context_templates
+        ],
+        words=[request["subject"] for _ in context_templates],
+        module_template=hparams.rewrite_module_tmp,
+        fact_token_strategy=hparams.fact_token,
+    )
+
+
 def find_fact_lookup_idx(
     prompt: str,
     subject: str,
@@ -294,3 +552,84 @@ def find_fact_lookup_idx(
         )
 
     return ret
+
+
+# Unit Tests
+def _unit_test():
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    words = "[PAD] The Eiffel Tower is in Rome Paris Danielle Darrieux speaks English a"
+    vocab = {w: i for i, w in enumerate(words.split())}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[PAD]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tok = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]")
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(
+            n_layer=4, n_embd=32, n_head=4, n_positions=32, vocab_size=len(vocab)
+        )
+    ).eval()
+    requests = [
+        dict(
+            prompt="{} is in", subject="The Eiffel Tower", target_new=dict(str="Rome")
+        ),
+        dict(
+            prompt="{} speaks",
+            subject="Danielle Darrieux",
+            target_new=dict(str="English"),
+        ),
+    ]
+    context_templates = ["{}", "Paris. {}"]
+
+    # Gradients of every step are recorded through the optimizer
+    grads = []
+
+    class RecordingAdam(torch.optim.Adam):
+        def step(self, *args, **kwargs):
+            grads.append(self.param_groups[0]["params"][0].grad.clone())
+            return super().step(*args, **kwargs)
+
+    adam, torch.optim.Adam = torch.optim.Adam, RecordingAdam
+    try:
+        for sparse in [False, True]:
+            results = []
+            for checkpoint in [False, True]:
+                hparams = ROMEHyperParams(
+                    layers=[1],
+                    v_num_grad_steps=4,
+                    v_partial_forward=True,
+                    v_sparse_logits=sparse,
+                    v_checkpoint_blocks=checkpoint,
+                )
+                grads.clear()
+                deltas, _ = optimize_v_deltas(
+                    model, tok, requests, hparams, 1, context_templates
+                )
+                results.append((deltas, list(grads)))
+            (d0, g0), (d1, g1) = results
+            assert len(g0) == len(g1) == 3
+            err = max((a - b).abs().max().item() for a, b in zip(g0, g1))
+            print(f"sparse_logits={sparse}: max abs gradient error {err}")
+            assert err < 1e-5 and (d0 - d1).abs().max() < 1e-5, err
+    finally:
+        torch.optim.Adam = adam
+
+    # Batched representations at the last token match unpadded single contexts
+    templates, subjects = ["{} is in", "Paris. The {} speaks"], ["Rome", "Eiffel"]
+    batched = get_module_input_output_at_words(
+        model, tok, 1, templates, subjects, "transformer.h.{}.mlp.c_proj", "last"
+    )
+    for i, (template, subject) in enumerate(zip(templates, subjects)):
+        single = get_module_input_output_at_word(
+            model, tok, 1, template, subject, "transformer.h.{}.mlp.c_proj", "last"
+        )
+        for x, y in zip(batched, single):
+            assert (x[i] - y).abs().max() < 1e-5
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
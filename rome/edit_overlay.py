@@ -0,0 +1,320 @@
+"""
+Keeps low-rank edits next to a model instead of writing them into its weights.
+
+Each edit set maps weight names to factors (U, V), where U lives in the
+input space of the module and V in its output space, so that the edited
+module computes
+
+    y = f(x) + (x @ U) @ V^T.
+
+This is exactly the effect of adding U V^T to the weight (in the
+orientation ROME uses), but enabling, disabling or rolling back edits only
+touches the factors, and many edit sets can be swapped in and out of one
+resident model without modifying its base weights.
+"""
+
+from typing import Dict, List, Tuple
+
+import torch
+
+from util import nethook
+
+from .rome_main import upd_matrix_match_shape
+
+
+class EditOverlay:
+    """
+    Applies stacked low-rank edits to a model through forward hooks.
+
+        overlay = EditOverlay(model)
+        apply_rome_to_model(model, tok, requests, hparams, overlay=overlay)
+        ...                     # model behaves as edited
+        overlay.rollback(0)     # model behaves as before
+
+    Edit sets are kept in the order they were added; `rollback(n)` keeps
+    the first n. `edits` and `load` can be used to swap whole histories.
+
+    The factors of each weight are stacked into buffers that grow
+    geometrically, so adding an edit set only copies its own factors.
+    """
+
+    def __init__(self, model: torch.nn.Module):
+        self.model = model
+        self.enabled = True
+        self._edits: List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]] = []
+        self._buffers: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._stacked: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._hooks = {}
+
+    def __len__(self):
+        return len(self._edits)
+
+    def add(self, deltas: Dict[str, Tuple[torch.Tensor, torch.Tensor]]) -> int:
+        """
+        Adds an edit set, as returned by `execute_rome`, and returns its index.
+        Factors may be vectors (rank-1) or matrices with one column per rank.
+        """
+
+        edit = {
+            w_name: (
+                u.detach().view(len(u), -1),
+                v.detach().view(len(v), -1),
+            )
+            for w_name, (u, v) in deltas.items()
+        }
+        self._edits.append(edit)
+        for w_name, (u, v) in edit.items():
+            self._append(w_name, u, v)
+        return len(self._edits) - 1
+
+    def rollback(self, n: int):
+        """
+        Keeps only the first n edit sets.
+        """
+
+        self._edits = self._edits[:n]
+        # The kept factors are a prefix of the buffers
+        ranks = {}
+        for edit in self._edits:
+            for w_name, (u, _) in edit.items():
+                ranks[w_name] = ranks.get(w_name, 0) + u.size(1)
+        self._stacked = {
+            w_name: (U[:, : ranks[w_name]], V[:, : ranks[w_name]])
+            for w_name, (U, V) in self._buffers.items()
+            if w_name in ranks
+        }
+
+    def clear(self):
+        self.rollback(0)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @property
+    def edits(self) -> List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]:
+        return list(self._edits)
+
+    def load(self, edits: List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]]):
+        """
+        Replaces all edit sets, e.g. with a list obtained from `edits`.
+        """
+
+        self._edits = []
+        self._buffers, self._stacked = {}, {}
+        for edit in edits:
+            self.add(edit)
+
+    @property
+    def weight_names(self) -> List[str]:
+        """
+        Names of the weights that currently have edits.
+        """
+
+        return list(self._stacked.keys())
+
+    def factors(self, w_name: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the stacked factors (U, V) currently applied to a weight,
+        as views that are only valid until the edits change.
+        """
+
+        return self._stacked[w_name]
+
+    def delta(self, w_name: str) -> torch.Tensor:
+        """
+        Materializes the dense update U V^T of a weight, in the weight's shape.
+        """
+
+        U, V = self._stacked[w_name]
+        return upd_matrix_match_shape(
+            U @ V.T, nethook.get_parameter(self.model, w_name).shape
+        )
+
+    def remove(self):
+        """
+        Removes all hooks from the model. The overlay cannot be used afterwards.
+        """
+
+        for handle in self._hooks.values():
+            handle.remove()
+        self._hooks = {}
+        self._edits, self._buffers, self._stacked = [], {}, {}
+
+    def _append(self, w_name: str, u: torch.Tensor, v: torch.Tensor):
+        """
+        Stacks the factors of one edit set after those of a weight.
+        """
+
+        rank = self._stacked[w_name][0].size(1) if w_name in self._stacked else 0
+        new_rank = rank + u.size(1)
+        if w_name not in self._buffers or self._buffers[w_name][0].size(1) < new_rank:
+            # Grow geometrically, keeping the stacked prefix
+            capacity = max(new_rank, 2 * rank, 16)
+            buffers = []
+            for x, old in zip((u, v), self._stacked.get(w_name, (None, None))):
+                buf = x.new_empty(len(x), capacity)
+                if old is not None:
+                    buf[:, :rank] = old
+                buffers.append(buf)
+            self._buffers[w_name] = tuple(buffers)
+
+        U, V = self._buffers[w_name]
+        U[:, rank:new_rank] = u
+        V[:, rank:new_rank] = v
+        self._stacked[w_name] = (U[:, :new_rank], V[:, :new_rank])
+
+        if w_name not in self._hooks:
+            module = nethook.get_module(self.model, w_name.rsplit(".", 1)[0])
+            self._hooks[w_name] = module.register_forward_hook(self._hook_for(w_name))
+
+    def _hook_for(self, w_name):
+        def overlay_hook(m, inputs, output):
+            if not self.enabled or w_name not in self._stacked:
+                return output
+            U, V = self._stacked[w_name]
+            x = inputs[0]
+            return output + ((x @ U.to(x.dtype)) @ V.T.to(x.dtype)).to(output.dtype)
+
+        return overlay_hook
+
+
+class RowwiseEdits:
+    """
+    Applies a different edit set to each row of a batch, through forward
+    hooks, so that prompts of independently edited models can share one
+    forward pass (or one generation loop) on the unedited model:
+
+        with RowwiseEdits(model, [deltas_a, deltas_b], rows=[0, 0, 1, -1]):
+            model(**inp)  # rows 0-1 edited by deltas_a, 2 by deltas_b, 3 not
+
+    Edit sets are in the format of `EditOverlay.add`. All factors of a weight
+    are stacked, and each row only keeps the columns of its own edit set.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        edits: List[Dict[str, Tuple[torch.Tensor, torch.Tensor]]],
+        rows: List[int],
+    ):
+        self.model = model
+        self._stacked = {}
+        for w_name in {w_name for edit in edits for w_name in edit}:
+            Us, Vs, owners = [], [], []
+            for i, edit in enumerate(edits):
+                if w_name in edit:
+                    u, v = edit[w_name]
+                    Us.append(u.detach().view(len(u), -1))
+                    Vs.append(v.detach().view(len(v), -1))
+                    owners += [i] * Us[-1].size(1)
+            U, V = torch.cat(Us, dim=1), torch.cat(Vs, dim=1)
+            # mask[b, r] selects the columns of the edit set of row b
+            mask = torch.tensor(rows)[:, None] == torch.tensor(owners)[None, :]
+            self._stacked[w_name] = (U, V, mask.to(U.device, U.dtype))
+        self._hooks = []
+
+    def __enter__(self):
+        for w_name in self._stacked:
+            module = nethook.get_module(self.model, w_name.rsplit(".", 1)[0])
+            self._hooks.append(module.register_forward_hook(self._hook_for(w_name)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for handle in self._hooks:
+            handle.remove()
+        self._hooks = []
+
+    def _hook_for(self, w_name):
+        def rowwise_hook(m, inputs, output):
+            U, V, mask = self._stacked[w_name]
+            x = inputs[0]
+            coeffs = (x @ U.to(x.dtype)) * mask.to(x.dtype)[:, None, :]
+            return output + (coeffs @ V.T.to(x.dtype)).to(output.dtype)
+
+        return rowwise_hook
+
+
+# Unit Tests
+def _unit_test():
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(n_layer=6, n_embd=64, n_head=4, n_positions=64, vocab_size=1000)
+    ).eval()
+    w_a, w_b = "transformer.h.2.mlp.c_proj.weight", "transformer.h.4.mlp.c_proj.weight"
+    edit_a = {w_a: (torch.randn(256), torch.randn(64))}
+    edit_b = {w: (torch.randn(256, 2) / 4, torch.randn(64, 2)) for w in [w_a, w_b]}
+
+    rows = [0, 1, -1]
+    input_ids = torch.randint(0, 1000, (len(rows), 10))
+    with torch.no_grad():
+        with RowwiseEdits(model, [edit_a, edit_b], rows=rows):
+            logits = model(input_ids=input_ids).logits
+
+        # Each row matches a forward pass with its edit written into the weights
+        for i, row in enumerate(rows):
+            deltas = {} if row == -1 else [edit_a, edit_b][row]
+            weights = {
+                w_name: nethook.get_parameter(model, w_name) for w_name in deltas
+            }
+            dense = {
+                w_name: upd_matrix_match_shape(
+                    u.view(len(u), -1) @ v.view(len(v), -1).T, weights[w_name].shape
+                )
+                for w_name, (u, v) in deltas.items()
+            }
+            for w_name in deltas:
+                weights[w_name].add_(dense[w_name])
+            expected = model(input_ids=input_ids[i : i + 1]).logits[0]
+            for w_name in deltas:
+                weights[w_name].sub_(dense[w_name])
+            err = (logits[i] - expected).abs().max().item()
+            print(f"Row {i} (edit set {row}): max abs error {err}")
+            assert err < 1e-4, err
+
+        # Hooks are gone after the context
+        assert (model(input_ids=input_ids).logits[2] - logits[2]).abs().max() < 1e-4
+        base = model(input_ids=input_ids).logits
+
+        # Stacked overlay edits, enough to grow the buffers, match their sum
+        # written into the weights, and roll back
+        history = [edit_a, edit_b] + [
+            {w_b: (torch.randn(256) / 4, torch.randn(64))} for _ in range(20)
+        ]
+        overlay = EditOverlay(model)
+        for edit in history:
+            overlay.add(edit)
+        assert overlay.factors(w_b)[0].shape == (256, 22)
+        deltas = {w_name: overlay.delta(w_name) for w_name in overlay.weight_names}
+        logits = model(input_ids=input_ids).logits
+        overlay.disable()
+        for w_name, delta in deltas.items():
+            nethook.get_parameter(model, w_name).add_(delta)
+        expected = model(input_ids=input_ids).logits
+        for w_name, delta in deltas.items():
+            nethook.get_parameter(model, w_name).sub_(delta)
+        overlay.enable()
+        err = (logits - expected).abs().max().item()
+        print(f"Overlay of {len(overlay)} edit sets: max abs error {err}")
+        assert err < 1e-4, err
+
+        overlay.rollback(2)
+        assert overlay.factors(w_b)[0].shape == (256, 2)
+        overlay.add(history[2])
+        assert (overlay.factors(w_b)[0][:, 2] == history[2][w_b][0]).all()
+        overlay.clear()
+        assert overlay.weight_names == []
+        assert (model(input_ids=input_ids).logits - base).abs().max() < 1e-6
+        overlay.load(history)
+        assert (model(input_ids=input_ids).logits - logits).abs().max() < 1e-5
+        overlay.remove()
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
@@ -1,20 +1,42 @@
+import hashlib
 import os
+import subprocess
+import sys
 from pathlib import Path
+from types import SimpleNamespace
 
 import torch
 from datasets import load_dataset
 from tqdm.auto import tqdm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
 
+from dsets import LocalTextDataset
 from util.globals import *
-from util.nethook import Trace, set_requires_grad
-from util.runningstats import CombinedStat, Mean, NormMean, SecondMoment, tally
+from util.nethook import TraceDict, set_requires_grad
+from util.runningstats import (
+    BlockedSecondMoment,
+    CombinedStat,
+    FixedRandomSubsetSampler,
+    LowRankSecondMoment,
+    Mean,
+    NormMean,
+    SecondMoment,
+    cached_state_exists,
+    load_cached_state,
+    pull_key_prefix,
+    remove_cached_state,
+    save_cached_state,
+    tally,
+)
 
 from .tok_dataset import (
+    LengthBucketedBatchSampler,
+    PretokenizedDataset,
     TokenizedDataset,
     dict_to_,
     flatten_masked_batch,
     length_collation,
+    pretokenize,
 )
 
 STAT_TYPES = {
@@ -23,6 +45,33 @@ STAT_TYPES = {
     "norm_mean": NormMean,
 }
 
+# Accumulators of the "mom2" stat; saved states are the same for all of them
+MOM2_IMPLS = {
+    "dense": SecondMoment,
+    "blocked": BlockedSecondMoment,
+}
+
+
+def local_corpus_ds_name(local_corpus):
+    """
+    Returns the dataset name under which stats of a local corpus are cached,
+    from its file name and a hash of its full path.
+    """
+
+    path = Path(local_corpus).resolve()
+    return f"local_{path.stem}_{hashlib.md5(str(path).encode()).hexdigest()[:8]}"
+
+
+def make_stat(name, stat_types=STAT_TYPES):
+    """
+    Instantiates the stat collected under `name`, where "sketch<r>" stands
+    for a rank-r LowRankSecondMoment.
+    """
+
+    if name.startswith("sketch"):
+        return LowRankSecondMoment(rank=int(name[len("sketch") :]))
+    return stat_types[name]()
+
 
 def main():
     """
@@ -44,34 +93,99 @@ def main():
     aa("--precision", default="float32", choices=["float64", "float32", "float16"])
     aa("--stats_dir", default=STATS_DIR)
     aa("--download", default=1, type=int, choices=[0, 1])
+    aa("--device", default="cuda")
+    aa("--num_shards", default=1, type=int)
+    aa("--shard", default=None, type=int)
+    aa("--merge_only", default=0, type=int, choices=[0, 1])
+    aa("--checkpoint_interval", default=100, type=int)
+    aa("--snapshot_sizes", default=[], type=lambda x: list(map(int, x.split(","))))
+    aa("--pretokenize", default=0, type=int, choices=[0, 1])
+    aa("--local_corpus", default=None, help="Text/JSONL file or directory to sample")
+    aa("--length_bucketing", default=0, type=int, choices=[0, 1])
+    aa("--mom2_impl", default="dense", choices=list(MOM2_IMPLS))
     args = parser.parse_args()
+    if args.local_corpus is not None:
+        args.dataset = local_corpus_ds_name(args.local_corpus)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
-    model = AutoModelForCausalLM.from_pretrained(args.model_name).eval().cuda()
-    set_requires_grad(False, model)
-
-    for layer_num in args.layers:
-        print(
-            f"Computing stats for layer {layer_num} of {args.model_name} "
-            f'over {args.sample_size or "all"} samples of {args.dataset}. '
-            "Note, the statistics are collected over the inputs to the second MLP layer, "
-            "or equivalently the outputs of the first MLP layer."
-        )
-        proj_layer_name = "c_proj" if "gpt2" in args.model_name else "fc_out"
-        layer_name = f"transformer.h.{layer_num}.mlp.{proj_layer_name}"
+    proj_layer_name = "c_proj" if "gpt2" in args.model_name else "fc_out"
+    layer_names = [
+        f"transformer.h.{layer_num}.mlp.{proj_layer_name}" for layer_num in args.layers
+    ]
 
-        layer_stats(
-            model,
-            tokenizer,
-            layer_name,
+    if args.num_shards > 1 and args.shard is None:
+        # Collect every shard in a local worker process unless the shards were
+        # already collected elsewhere (e.g. by other hosts, passing --shard),
+        # then reduce them into the usual cache files.
+        if not args.merge_only:
+            run_local_shards(args.num_shards, args.device)
+        merge_layer_stats_shards(
+            # Only the config is needed to name the files
+            SimpleNamespace(config=AutoConfig.from_pretrained(args.model_name)),
+            layer_names,
             args.stats_dir,
             args.dataset,
             args.to_collect,
+            args.num_shards,
             sample_size=args.sample_size,
             precision=args.precision,
             batch_tokens=args.batch_tokens,
-            download=args.download,
         )
+        return
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    model = AutoModelForCausalLM.from_pretrained(args.model_name).eval()
+    model = model.to(args.device)
+    set_requires_grad(False, model)
+
+    print(
+        f"Computing stats for layers {args.layers} of {args.model_name} "
+        f'over {args.sample_size or "all"} samples of {args.dataset}. '
+        "Note, the statistics are collected over the inputs to the second MLP layer, "
+        "or equivalently the outputs of the first MLP layer."
+    )
+    # All layers are collected in a single pass over the dataset
+    multi_layer_stats(
+        model,
+        tokenizer,
+        layer_names,
+        args.stats_dir,
+        args.dataset,
+        args.to_collect,
+        sample_size=args.sample_size,
+        precision=args.precision,
+        batch_tokens=args.batch_tokens,
+        download=args.download,
+        shard=args.shard,
+        num_shards=args.num_shards,
+        checkpoint_interval=args.checkpoint_interval or None,
+        snapshot_sizes=args.snapshot_sizes,
+        pretokenized=bool(args.pretokenize),
+        local_corpus=args.local_corpus,
+        length_bucketing=bool(args.length_bucketing),
+        mom2_impl=args.mom2_impl,
+    )
+
+
+def run_local_shards(num_shards, device):
+    """
+    Runs this script once per shard, in parallel local processes, with the
+    same arguments plus --shard. GPU workers are spread over the visible
+    devices; CPU workers split the available cores.
+    """
+
+    procs = []
+    n_gpus = torch.cuda.device_count() if device.startswith("cuda") else 0
+    for shard in range(num_shards):
+        env = dict(os.environ)
+        if n_gpus > 0:
+            env["CUDA_VISIBLE_DEVICES"] = str(shard % n_gpus)
+        else:
+            env["OMP_NUM_THREADS"] = str(max(1, os.cpu_count() // num_shards))
+        cmd = [sys.executable, "-m", "rome.layer_stats", *sys.argv[1:]]
+        procs.append(subprocess.Popen(cmd + ["--shard", str(shard)], env=env))
+
+    failed = [shard for shard, p in enumerate(procs) if p.wait() != 0]
+    assert not failed, f"Shards {failed} failed"
 
 
 def layer_stats(
@@ -87,20 +201,121 @@ def layer_stats(
     batch_tokens=None,
     download=True,
     progress=tqdm,
+    local_corpus=None,
+):
+    """
+    Function to load or compute cached stats. See `multi_layer_stats`.
+    """
+
+    return multi_layer_stats(
+        model,
+        tokenizer,
+        [layer_name],
+        stats_dir,
+        ds_name,
+        to_collect,
+        model_name=model_name,
+        sample_size=sample_size,
+        precision=precision,
+        batch_tokens=batch_tokens,
+        download=download,
+        progress=progress,
+        local_corpus=local_corpus,
+    )[layer_name]
+
+
+def multi_layer_stats(
+    model,
+    tokenizer,
+    layer_names,
+    stats_dir,
+    ds_name,
+    to_collect,
+    model_name=None,
+    sample_size=None,
+    precision=None,
+    batch_tokens=None,
+    download=True,
+    progress=tqdm,
+    shard=None,
+    num_shards=1,
+    checkpoint_interval=None,
+    snapshot_sizes=None,
+    pretokenized=False,
+    local_corpus=None,
+    length_bucketing=False,
+    mom2_impl="dense",
 ):
     """
-    Function to load or compute cached stats.
+    Loads or computes cached stats for several layers at once. The stats of
+    all layers that are not cached are collected in a single pass over the
+    dataset, stopping each forward pass after the deepest of them. Each
+    layer's stats are cached in the same file `layer_stats` would use.
+
+    If `shard` is given, the sample is split into `num_shards` disjoint
+    parts, and only part number `shard` is collected and saved to a partial
+    file. Once all parts exist, `merge_layer_stats_shards` reduces them.
+
+    If `checkpoint_interval` is given, the partial stats are checkpointed
+    every that many batches, and an interrupted collection resumes from the
+    last checkpoint when called again with the same arguments.
+
+    `snapshot_sizes` lists smaller sample sizes (multiples of 100) whose
+    stats are saved along the way, since the random sample of each of them
+    is a prefix of the full one. Later lookups with those sample sizes then
+    load the snapshots instead of recomputing.
+
+    If `pretokenized` is set, the whole dataset is tokenized once and stored
+    memory-mapped under stats_dir/tokenized, to be reused by every later
+    collection with the same tokenizer and maximum length. Existing
+    pretokenized data is always used.
+
+    If `local_corpus` is given (a text or JSONL file, or a directory of
+    them), the sample is drawn from it by reservoir sampling in a single
+    streaming read, instead of from the Hugging Face dataset; `ds_name`
+    then only names the cache files.
+
+    If `length_bucketing` is set, the token length of every sampled text is
+    computed up front (cheaply, if pretokenized), and the whole sample is
+    sorted by length into batches of up to `batch_tokens` padded tokens,
+    instead of sorting each chunk of 100 random texts. The sample and the
+    resulting stats are the same, with far less padding; snapshots are
+    not available, since batches are no longer prefixes of the sample.
+
+    `mom2_impl` names the accumulator of "mom2" in MOM2_IMPLS. "blocked"
+    only accumulates one triangle, in blocks, which is faster on CPUs (see
+    `python -m util.runningstats --benchmark`); the cached stats are the
+    same either way.
+
+    Returns a dict mapping each layer name to its CombinedStat.
     """
 
     def get_ds():
-        raw_ds = load_dataset(
-            ds_name,
-            dict(wikitext="wikitext-103-raw-v1", wikipedia="20200501.en")[ds_name],
-        )
         maxlen = model.config.n_positions
         if batch_tokens is not None and batch_tokens < maxlen:
             maxlen = batch_tokens
-        return TokenizedDataset(raw_ds["train"], tokenizer, maxlen=maxlen)
+        # Local corpora are sampled before tokenization
+        local_suffix = "" if local_corpus is None else f"_n{sample_size}"
+        tokenized_dir = (
+            Path(stats_dir)
+            / "tokenized"
+            / tokenizer.name_or_path.replace("/", "_")
+            / f"{ds_name}_maxlen{maxlen}{local_suffix}"
+        )
+        if tokenized_dir.exists():
+            return PretokenizedDataset(tokenized_dir)
+
+        if local_corpus is not None:
+            raw_ds = LocalTextDataset(local_corpus, sample_size=sample_size)
+        else:
+            raw_ds = load_dataset(
+                ds_name,
+                dict(wikitext="wikitext-103-raw-v1", wikipedia="20200501.en")[ds_name],
+            )["train"]
+        if pretokenized:
+            pretokenize(raw_ds, tokenizer, maxlen, tokenized_dir)
+            return PretokenizedDataset(tokenized_dir)
+        return TokenizedDataset(raw_ds, tokenizer, maxlen=maxlen)
 
     # Continue with computation of statistics
     batch_size = 100  # Examine this many dataset texts at once
@@ -110,59 +325,259 @@ def layer_stats(
     if precision is None:
         precision = "float64"
     dtype = getattr(torch, precision)
-    size_suffix = "" if sample_size is None else f"_{sample_size}"
-    if batch_tokens < npos:
-        size_suffix = "_t{batch_tokens}" + size_suffix
-    if model_name is None:
-        model_name = model.config._name_or_path.replace("/", "_")
+    device = next(model.parameters()).device
+    stat_types = dict(STAT_TYPES, mom2=MOM2_IMPLS[mom2_impl])
+
+    def get_file_extension(layer_name, sample_size):
+        return layer_stats_file_extension(
+            model,
+            layer_name,
+            ds_name,
+            to_collect,
+            model_name=model_name,
+            sample_size=sample_size,
+            precision=precision,
+            batch_tokens=batch_tokens,
+        )
 
     stats_dir = Path(stats_dir)
-    file_extension = f"{model_name}/{ds_name}_stats/{layer_name}_{precision}_{'-'.join(sorted(to_collect))}{size_suffix}.npz"
-    filename = stats_dir / file_extension
-
-    if not filename.exists() and download:
-        remote_url = f"{REMOTE_ROOT_URL}/data/stats/{file_extension}"
-        try:
-            print(f"Attempting to download {file_extension} from {remote_url}.")
-            (stats_dir / "/".join(file_extension.split("/")[:-1])).mkdir(
-                exist_ok=True, parents=True
-            )
-            torch.hub.download_url_to_file(remote_url, filename)
-            print("Successfully downloaded.")
-        except Exception as e:
-            print(f"Unable to download due to {e}. Computing locally....")
+    stats, filenames = {}, {}
+    for layer_name in layer_names:
+        file_extension = get_file_extension(layer_name, sample_size)
+        filename = filenames[layer_name] = stats_dir / file_extension
 
-    ds = get_ds() if not filename.exists() else None
+        # Stats of local corpora are never hosted
+        if not cached_state_exists(filename) and download and local_corpus is None:
+            remote_url = f"{REMOTE_ROOT_URL}/data/stats/{file_extension}"
+            try:
+                print(f"Attempting to download {file_extension} from {remote_url}.")
+                (stats_dir / "/".join(file_extension.split("/")[:-1])).mkdir(
+                    exist_ok=True, parents=True
+                )
+                torch.hub.download_url_to_file(remote_url, filename)
+                print("Successfully downloaded.")
+            except Exception as e:
+                print(f"Unable to download due to {e}. Computing locally....")
+
+        stats[layer_name] = CombinedStat(
+            **{k: make_stat(k, stat_types) for k in to_collect}
+        )
+
+    # Load what is cached; the remaining layers are collected together
+    cache_args = dict(sample_size=sample_size)
+    pending = []
+    for layer_name in layer_names:
+        cached_state = load_cached_state(filenames[layer_name], cache_args)
+        if cached_state is None and shard is not None:
+            filenames[layer_name] = shard_filename(
+                filenames[layer_name], shard, num_shards
+            )
+            cached_state = load_cached_state(filenames[layer_name], cache_args)
+        if cached_state is not None:
+            stats[layer_name].load_state_dict(cached_state)
+        else:
+            pending.append(layer_name)
+    if len(pending) == 0:
+        return stats
 
     if progress is None:
         progress = lambda x: x
 
-    stat = CombinedStat(**{k: STAT_TYPES[k]() for k in to_collect})
+    ds = get_ds()
+    if shard is None:
+        sample_args = dict(sample_size=sample_size, random_sample=1)
+        sample_count = sample_size or len(ds)
+        start, end = 0, sample_count
+    else:
+        # Shards split the same shuffled prefix that random_sample=1 draws
+        n = len(ds) if sample_size is None else min(sample_size, len(ds))
+        start, end = shard * n // num_shards, (shard + 1) * n // num_shards
+        sample_args = dict(
+            sampler=FixedRandomSubsetSampler(ds, start=start, end=end, seed=1)
+        )
+        sample_count = end - start
+        print(f"Collecting shard {shard} of {num_shards}: samples {start}-{end}")
+    batch_args = dict(batch_size=batch_size)
+    batch_count = -(-sample_count // batch_size)
+    if length_bucketing:
+        # Same samples as above, regrouped by length across the whole sample
+        indices = FixedRandomSubsetSampler(ds, start=start, end=end, seed=1).samples
+        batch_args = dict(
+            batch_sampler=LengthBucketedBatchSampler(
+                indices, ds.lengths(indices), batch_tokens, chunk_size=batch_size
+            )
+        )
+        sample_args = {}
+        batch_count = len(batch_args["batch_sampler"])
+
+    # The checkpoint holds the stats of all pending layers, so its name
+    # depends on which layers are being collected together
+    layers_hash = hashlib.md5(",".join(pending).encode()).hexdigest()[:8]
+    first_file = filenames[pending[0]]
+    # Bucketed batches are counted differently, so are checkpointed apart
+    bucket_suffix = "_lb" if length_bucketing else ""
+    checkpoint = first_file.with_name(
+        f"{first_file.stem}_ckpt_{layers_hash}{bucket_suffix}.npz"
+    )
+
+    # Prefixes of the sample are only well-defined for random subsamples,
+    # and are not the smaller reservoir samples of a local corpus
+    snapshot_sizes = [
+        n
+        for n in snapshot_sizes or []
+        if shard is None
+        and local_corpus is None
+        and not length_bucketing
+        and sample_size is not None
+        and n < sample_size
+    ]
+    snapshots = {
+        n: first_file.with_name(f"{first_file.stem}_snap{n}_{layers_hash}.npz")
+        for n in snapshot_sizes
+    }
+
+    pending_stat = CombinedStat(**{str(i): stats[n] for i, n in enumerate(pending)})
     loader = tally(
-        stat,
+        pending_stat,
         ds,
-        cache=filename,
-        sample_size=sample_size,
-        batch_size=batch_size,
+        checkpoint=checkpoint if checkpoint_interval else None,
+        checkpoint_interval=checkpoint_interval,
+        snapshots=snapshots,
+        device=device,
         collate_fn=length_collation(batch_tokens),
         pin_memory=True,
-        random_sample=1,
         num_workers=2,
+        **batch_args,
+        **sample_args,
     )
-    batch_count = -(-(sample_size or len(ds)) // batch_size)
     with torch.no_grad():
         for batch_group in progress(loader, total=batch_count):
             for batch in batch_group:
-                batch = dict_to_(batch, "cuda")
-                with Trace(
-                    model, layer_name, retain_input=True, retain_output=False, stop=True
+                batch = dict_to_(batch, device)
+                with TraceDict(
+                    model, pending, retain_input=True, retain_output=False, stop=True
                 ) as tr:
                     model(**batch)
-                feats = flatten_masked_batch(tr.input, batch["attention_mask"])
-                # feats = flatten_masked_batch(tr.output, batch["attention_mask"])
-                feats = feats.to(dtype=dtype)
-                stat.add(feats)
-    return stat
+                for layer_name in pending:
+                    feats = flatten_masked_batch(
+                        tr[layer_name].input, batch["attention_mask"]
+                    )
+                    feats = feats.to(dtype=dtype)
+                    stats[layer_name].add(feats)
+
+    for layer_name in pending:
+        save_cached_state(filenames[layer_name], stats[layer_name], cache_args)
+
+    # Snapshots hold the stats of all pending layers; split them per layer
+    for n, snapshot in snapshots.items():
+        snapshot_state = load_cached_state(snapshot, dict(sample_size=n), quiet=True)
+        if snapshot_state is None:
+            continue
+        for i, layer_name in enumerate(pending):
+            layer_stat = CombinedStat(**{k: make_stat(k) for k in to_collect})
+            layer_stat.load_state_dict(pull_key_prefix(str(i), snapshot_state))
+            save_cached_state(
+                stats_dir / get_file_extension(layer_name, n),
+                layer_stat,
+                dict(sample_size=n),
+            )
+        remove_cached_state(snapshot)
+        print(f"Saved stats of the first {n} samples")
+
+    return stats
+
+
+def merge_layer_stats_shards(
+    model,
+    layer_names,
+    stats_dir,
+    ds_name,
+    to_collect,
+    num_shards,
+    model_name=None,
+    sample_size=None,
+    precision=None,
+    batch_tokens=None,
+):
+    """
+    Reduces the partial stats written by `multi_layer_stats(..., shard=i)`
+    for every i < num_shards into the cache files of the full stats, and
+    removes the partial files.
+    """
+
+    stats_dir = Path(stats_dir)
+    cache_args = dict(sample_size=sample_size)
+    for layer_name in layer_names:
+        filename = stats_dir / layer_stats_file_extension(
+            model,
+            layer_name,
+            ds_name,
+            to_collect,
+            model_name=model_name,
+            sample_size=sample_size,
+            precision=precision,
+            batch_tokens=batch_tokens,
+        )
+        if cached_state_exists(filename):
+            print(f"{filename} already exists, not merging shards")
+            continue
+
+        shard_files = [
+            shard_filename(filename, i, num_shards) for i in range(num_shards)
+        ]
+        missing = [str(f) for f in shard_files if not cached_state_exists(f)]
+        assert not missing, f"Missing shards {missing}"
+
+        stat = CombinedStat(**{k: make_stat(k) for k in to_collect})
+        for f in shard_files:
+            shard_stat = CombinedStat(**{k: make_stat(k) for k in to_collect})
+            shard_stat.load_state_dict(
+                load_cached_state(f, cache_args, quiet=True, throw=True)
+            )
+            stat.merge(shard_stat)
+        save_cached_state(filename, stat, cache_args)
+        print(f"Merged {num_shards} shards into {filename}")
+
+        for f in shard_files:
+            remove_cached_state(f)
+
+
+def shard_filename(filename, shard, num_shards):
+    """
+    Returns the name of the partial stats file of one shard.
+    """
+
+    filename = Path(filename)
+    return filename.with_name(f"{filename.stem}_shard{shard}of{num_shards}.npz")
+
+
+def layer_stats_file_extension(
+    model,
+    layer_name,
+    ds_name,
+    to_collect,
+    model_name=None,
+    sample_size=None,
+    precision=None,
+    batch_tokens=None,
+):
+    """
+    Returns the path, relative to the stats directory, of the file in which
+    `layer_stats` caches the given statistics.
+    """
+
+    npos = model.config.n_positions
+    if batch_tokens is None:
+        batch_tokens = npos * 3
+    if precision is None:
+        precision = "float64"
+    size_suffix = "" if sample_size is None else f"_{sample_size}"
+    if batch_tokens < npos:
+        size_suffix = "_t{batch_tokens}" + size_suffix
+    if model_name is None:
+        model_name = model.config._name_or_path.replace("/", "_")
+
+    return f"{model_name}/{ds_name}_stats/{layer_name}_{precision}_{'-'.join(sorted(to_collect))}{size_suffix}.npz"
 
 
 if __name__ == "__main__":
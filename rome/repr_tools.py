@@ -138,11 +138,13 @@ def get_reprs_at_idxs(
         )
 
         with torch.no_grad():
+            # Nothing above the traced module is needed, so stop right after it
             with nethook.Trace(
                 module=model,
                 layer=module_name,
                 retain_input=tin,
                 retain_output=tout,
+                stop=True,
             ) as tr:
                 model(**contexts_tok)
 
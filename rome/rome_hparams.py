@@ -1,5 +1,5 @@
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Optional
 
 from util.hparams import HyperParams
 
@@ -20,6 +20,12 @@ class ROMEHyperParams(HyperParams):
     v_weight_decay: float = field(default=0.5)
     clamp_norm_factor: float = field(default=4.0)
     kl_factor: float = field(default=0.0625)
+    v_partial_forward: bool = field(default=False)
+    v_sparse_logits: bool = field(default=False)
+    v_checkpoint_blocks: bool = field(default=False)
+    v_batch_size: int = field(default=1)
+    joint_solve: bool = field(default=False)
+    joint_solve_reg: float = field(default=0.0)
     mom2_adjustment: bool = field(default=True)
     context_template_length_params: List[List[int]] = field(default_factory=list)
 
@@ -35,3 +41,7 @@ class ROMEHyperParams(HyperParams):
     mom2_dataset: str = field(default="wikipedia")
     mom2_n_samples: int = field(default=100000)
     mom2_dtype: str = field(default="float32")
+    mom2_factor: str = field(default="cholesky")
+    mom2_reg: float = field(default=0.0)
+    mom2_sketch_rank: int = field(default=256)
+    mom2_local_corpus: Optional[str] = field(default=None)
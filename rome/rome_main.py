@@ -1,3 +1,5 @@
+import json
+import os
 from copy import deepcopy
 from typing import Dict, List, Tuple
 
@@ -6,12 +8,20 @@ from transformers import AutoModelForCausalLM, AutoTokenizer
 
 from util import nethook
 from util.generate import generate_fast
-
-from .compute_u import compute_u
-from .compute_v import compute_v
+from util.globals import *
+
+from .compute_u import apply_inv_cov, compute_key, compute_u
+from .compute_v import (
+    compute_v,
+    compute_vs,
+    get_template_reprs,
+    get_v_targets,
+    optimize_v_deltas,
+)
 from .rome_hparams import ROMEHyperParams
 
 CONTEXT_TEMPLATES_CACHE = None
+CONTEXT_TEMPLATES_SEED = 0
 
 
 def apply_rome_to_model(
@@ -21,12 +31,20 @@ def apply_rome_to_model(
     hparams: ROMEHyperParams,
     copy=False,
     return_orig_weights=False,
+    overlay=None,
+    journal=None,
+    distance_tracker=None,
 ) -> Tuple[AutoModelForCausalLM, List[str]]:
     """
     Returns a model with the desired changes.
 
     :param copy: If true, will preserve the original model while creating a new one to edit.
         Note that you are responsible for deallocating the new model's memory to avoid leaks.
+    :param overlay: An `EditOverlay` of the model. If given, edits are added to it
+        instead of being written into the weights, and no weights are copied.
+    :param journal: An `EditJournal` to which the factors of every edit are appended.
+    :param distance_tracker: An `EditDistanceTracker` to which the factors of every
+        edit are appended.
 
     :return: (1) the updated model, (2) an original copy of the weights that changed
     """
@@ -44,26 +62,63 @@ def apply_rome_to_model(
         )
 
     if copy:
+        assert overlay is None, "Cannot copy a model with an overlay"
         model = deepcopy(model)
 
     weights_copy = {}
 
-    for i, request in enumerate(requests):
-        deltas = execute_rome(model, tok, request, hparams)
+    # Requests are either edited one after another, in groups of v_batch_size
+    # whose deltas are all computed against the same weights, or all together
+    # with a single joint update.
+    batch_size = max(len(requests) if hparams.joint_solve else hparams.v_batch_size, 1)
+    if not hparams.joint_solve and batch_size > 1 and len(requests) > 1:
+        print(
+            f"WARNING: v_batch_size={batch_size} computes the deltas of each group "
+            "against the same weights, then applies them one after another. "
+            "Results differ from sequential edits; set v_batch_size=1 to edit "
+            "sequentially, or joint_solve to solve for all requests together."
+        )
+    for i in range(0, len(requests), batch_size):
+        if hparams.joint_solve:
+            all_deltas = [execute_rome_joint(model, tok, requests, hparams)]
+        elif batch_size == 1:
+            all_deltas = [execute_rome(model, tok, requests[i], hparams)]
+        else:
+            all_deltas = execute_rome_batch(
+                model, tok, requests[i : i + batch_size], hparams
+            )
+
+        if journal is not None:
+            for deltas in all_deltas:
+                journal.append(deltas)
+        if distance_tracker is not None:
+            for deltas in all_deltas:
+                distance_tracker.append(deltas)
+
+        if overlay is not None:
+            for deltas in all_deltas:
+                overlay.add(deltas)
+            print(f"New edits successfully added to {list(all_deltas[0].keys())}")
+            continue
 
         with torch.no_grad():
-            for w_name, (delta_u, delta_v) in deltas.items():
-                upd_matrix = delta_u.unsqueeze(1) @ delta_v.unsqueeze(0)
-                w = nethook.get_parameter(model, w_name)
-                upd_matrix = upd_matrix_match_shape(upd_matrix, w.shape)
+            for j, deltas in enumerate(all_deltas):
+                for w_name, (delta_u, delta_v) in deltas.items():
+                    # Rank-1 updates have vector factors; joint updates have
+                    # one column per request.
+                    upd_matrix = delta_u.view(len(delta_u), -1) @ delta_v.view(
+                        len(delta_v), -1
+                    ).T
+                    w = nethook.get_parameter(model, w_name)
+                    upd_matrix = upd_matrix_match_shape(upd_matrix, w.shape)
 
-                if return_orig_weights and w_name not in weights_copy:
-                    assert i == 0
-                    weights_copy[w_name] = w.detach().clone()
+                    if return_orig_weights and w_name not in weights_copy:
+                        assert i == j == 0
+                        weights_copy[w_name] = w.detach().clone()
 
-                w[...] += upd_matrix
+                    w[...] += upd_matrix
 
-        print(f"New weights successfully inserted into {list(deltas.keys())}")
+        print(f"New weights successfully inserted into {list(all_deltas[0].keys())}")
 
     return model, weights_copy
 
@@ -79,15 +134,7 @@ def execute_rome(
     Invariant: model at beginning of function == model at end of function
     """
 
-    # Update target and print info
-    request = deepcopy(request)
-    if request["target_new"]["str"][0] != " ":
-        # Space required for correct tokenization
-        request["target_new"]["str"] = " " + request["target_new"]["str"]
-    print(
-        f"Executing ROME algorithm for the update: "
-        f"[{request['prompt'].format(request['subject'])}] -> [{request['target_new']['str']}]"
-    )
+    request = prepare_request(request)
 
     # Retrieve weights that user desires to change
     weights = {
@@ -102,6 +149,17 @@ def execute_rome(
     # Update loop: sequentially intervene at each specified layer
     deltas = {}
     for layer in sorted(hparams.layers):
+        context_templates = get_context_templates(
+            model, tok, hparams.context_template_length_params
+        )
+        # With random prefix keys, compute_u and compute_v read the same
+        # module inputs/outputs, which are extracted once for all templates.
+        template_reprs = (
+            get_template_reprs(model, tok, request, hparams, layer, context_templates)
+            if hparams.enable_random_prefix_keys
+            else None
+        )
+
         # Compute rank-1 update matrix
         left_vector: torch.Tensor = compute_u(
             model,
@@ -109,7 +167,8 @@ def execute_rome(
             request,
             hparams,
             layer,
-            get_context_templates(model, tok, hparams.context_template_length_params),
+            context_templates,
+            template_reprs=template_reprs,
         )
         print("Left vector shape:", left_vector.shape)
         right_vector: torch.Tensor = compute_v(
@@ -119,7 +178,8 @@ def execute_rome(
             hparams,
             layer,
             left_vector,
-            get_context_templates(model, tok, hparams.context_template_length_params),
+            context_templates,
+            template_reprs=template_reprs,
         )
         print("Right vector shape:", right_vector.shape)
 
@@ -146,6 +206,178 @@ def execute_rome(
     return deltas
 
 
+def execute_rome_batch(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    requests: List[Dict],
+    hparams: ROMEHyperParams,
+) -> List[Dict[str, Tuple[torch.Tensor]]]:
+    """
+    Executes the ROME update algorithm for several requests, optimizing their
+    v* vectors jointly in one batch. Returns the same deltas as calling
+    `execute_rome` on each request against the current model.
+    Invariant: model at beginning of function == model at end of function
+    """
+
+    if len(hparams.layers) != 1:
+        # Later layers of a request must see the update of its earlier layers,
+        # which cannot be shared across the requests of a batch.
+        print("Batched execution requires a single layer; editing one at a time.")
+        return [execute_rome(model, tok, request, hparams) for request in requests]
+
+    requests = [prepare_request(request) for request in requests]
+    layer = hparams.layers[0]
+    weight_name = f"{hparams.rewrite_module_tmp.format(layer)}.weight"
+    context_templates = get_context_templates(
+        model, tok, hparams.context_template_length_params
+    )
+
+    all_template_reprs = [
+        get_template_reprs(model, tok, request, hparams, layer, context_templates)
+        if hparams.enable_random_prefix_keys
+        else None
+        for request in requests
+    ]
+    left_vectors = [
+        compute_u(
+            model,
+            tok,
+            request,
+            hparams,
+            layer,
+            context_templates,
+            template_reprs=template_reprs,
+        )
+        for request, template_reprs in zip(requests, all_template_reprs)
+    ]
+    print("Left vector shape:", left_vectors[0].shape)
+    right_vectors = compute_vs(
+        model,
+        tok,
+        requests,
+        hparams,
+        layer,
+        left_vectors,
+        context_templates,
+        all_template_reprs=all_template_reprs,
+    )
+    print("Right vector shape:", right_vectors[0].shape)
+
+    print(f"Deltas successfully computed for {[weight_name]}")
+
+    return [
+        {weight_name: (left_vector.detach(), right_vector.detach())}
+        for left_vector, right_vector in zip(left_vectors, right_vectors)
+    ]
+
+
+def execute_rome_joint(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    requests: List[Dict],
+    hparams: ROMEHyperParams,
+) -> Dict[str, Tuple[torch.Tensor]]:
+    """
+    Computes a single low-rank update that inserts all requests at once.
+
+    With K_u the keys from compute_u, K the keys at the rewrite module, and R
+    the residuals (v* - W k) from the v* optimization, solves the regularized
+    least-squares problem min ||dW K - R||^2 + reg * tr(dW C dW^T), whose
+    solution is (taking K_u = K, as with random prefix keys)
+
+        dW = R (K_u^T C^-1 K + reg * I)^-1 (C^-1 K_u)^T.
+
+    For a single request and reg = 0 this is exactly the ROME rank-1 update.
+    Returns the factors (U, V) of dW = U V^T, with one column per request.
+    Invariant: model at beginning of function == model at end of function
+    """
+
+    assert len(hparams.layers) == 1, "Joint solve requires a single layer"
+
+    requests = [prepare_request(request) for request in requests]
+    layer = hparams.layers[0]
+    weight_name = f"{hparams.rewrite_module_tmp.format(layer)}.weight"
+    context_templates = get_context_templates(
+        model, tok, hparams.context_template_length_params
+    )
+
+    # Collect keys and target residuals of all requests
+    key_us, keys, residuals = [], [], []
+    batch_size = max(hparams.v_batch_size, 1)
+    for i in range(0, len(requests), batch_size):
+        batch = requests[i : i + batch_size]
+        deltas, target_inits = optimize_v_deltas(
+            model, tok, batch, hparams, layer, context_templates
+        )
+        for request, delta, target_init in zip(batch, deltas, target_inits):
+            template_reprs = (
+                get_template_reprs(
+                    model, tok, request, hparams, layer, context_templates
+                )
+                if hparams.enable_random_prefix_keys
+                else None
+            )
+            key_us.append(
+                compute_key(
+                    model,
+                    tok,
+                    request,
+                    hparams,
+                    layer,
+                    context_templates,
+                    template_reprs=template_reprs,
+                )
+            )
+            cur_input, cur_output, target = get_v_targets(
+                model,
+                tok,
+                request,
+                hparams,
+                layer,
+                context_templates,
+                delta,
+                target_init,
+                template_reprs=template_reprs,
+            )
+            keys.append(cur_input)
+            residuals.append(target - cur_output)
+
+    K_u, K, R = (torch.stack(x, dim=1) for x in [key_us, keys, residuals])
+
+    # Solve the joint system
+    with torch.no_grad():
+        U = K_u
+        if hparams.mom2_adjustment:
+            U = apply_inv_cov(model, tok, hparams, layer, U)
+        A = U.T @ K + hparams.joint_solve_reg * torch.eye(
+            len(requests), dtype=U.dtype, device=U.device
+        )
+        V = torch.linalg.solve(A, R, left=False)
+
+    print(f"Joint update of rank {len(requests)} computed for {[weight_name]}")
+
+    return {weight_name: (U.detach(), V.detach())}
+
+
+def prepare_request(request: Dict) -> Dict:
+    """
+    Returns a copy of the request whose target is ready for tokenization,
+    and prints it.
+    """
+
+    # Update target and print info
+    request = deepcopy(request)
+    if request["target_new"]["str"][0] != " ":
+        # Space required for correct tokenization
+        request["target_new"]["str"] = " " + request["target_new"]["str"]
+    print(
+        f"Executing ROME algorithm for the update: "
+        f"[{request['prompt'].format(request['subject'])}] -> [{request['target_new']['str']}]"
+    )
+
+    return request
+
+
 def upd_matrix_match_shape(matrix: torch.Tensor, shape: torch.Size) -> torch.Tensor:
     """
     GPT-2 and GPT-J have transposed weight representations.
@@ -163,26 +395,56 @@ def upd_matrix_match_shape(matrix: torch.Tensor, shape: torch.Size) -> torch.Ten
         )
 
 
-def get_context_templates(model, tok, length_params):
+def get_context_templates(
+    model, tok, length_params, seed=CONTEXT_TEMPLATES_SEED, regenerate=False
+):
+    """
+    Returns the context templates used to average keys and v* targets over.
+    Templates are sampled once per (model, length_params, seed) with a fixed
+    seed and stored under STATS_DIR, so later processes load them from disk.
+    Set `regenerate` to sample them anew and overwrite the stored copy.
+    """
+
     global CONTEXT_TEMPLATES_CACHE
 
-    if CONTEXT_TEMPLATES_CACHE is None:
-        CONTEXT_TEMPLATES_CACHE = ["{}"] + [
-            x + ". {}"
-            for x in sum(
-                (
-                    generate_fast(
-                        model,
-                        tok,
-                        ["<|endoftext|>"],
-                        n_gen_per_prompt=n_gen,
-                        max_out_len=length,
+    if CONTEXT_TEMPLATES_CACHE is None or regenerate:
+        model_name = model.config._name_or_path.replace("/", "_")
+        lengths_str = "_".join(f"{length}x{n_gen}" for length, n_gen in length_params)
+        cache_file = (
+            STATS_DIR / model_name / "context_templates" / f"{lengths_str}_seed{seed}.json"
+        )
+
+        if cache_file.exists() and not regenerate:
+            print(f"Loading cached context templates from {cache_file}")
+            with open(cache_file, "r") as f:
+                CONTEXT_TEMPLATES_CACHE = json.load(f)
+        else:
+            with torch.random.fork_rng():
+                torch.manual_seed(seed)
+                CONTEXT_TEMPLATES_CACHE = ["{}"] + [
+                    x + ". {}"
+                    for x in sum(
+                        (
+                            generate_fast(
+                                model,
+                                tok,
+                                ["<|endoftext|>"],
+                                n_gen_per_prompt=n_gen,
+                                max_out_len=length,
+                            )
+                            for length, n_gen in length_params
+                        ),
+                        [],
                     )
-                    for length, n_gen in length_params
-                ),
-                [],
-            )
-        ]
+                ]
+
+            # Written aside and renamed, so concurrent readers never see
+            # a partial file
+            cache_file.parent.mkdir(exist_ok=True, parents=True)
+            tmp_file = cache_file.with_name(f"{cache_file.stem}.tmp{os.getpid()}.json")
+            with open(tmp_file, "w") as f:
+                json.dump(CONTEXT_TEMPLATES_CACHE, f, indent=1)
+            os.replace(tmp_file, cache_file)
 
         print(f"Cached context templates {CONTEXT_TEMPLATES_CACHE}")
 
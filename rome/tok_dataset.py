@@ -1,6 +1,11 @@
+import os
+import shutil
+from pathlib import Path
+
+import numpy
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
 
 class TokenizedDataset(Dataset):
@@ -36,6 +41,104 @@ class TokenizedDataset(Dataset):
             attention_mask=torch.tensor(attention_mask),
         )
 
+    def lengths(self, indices, batch_size=1000):
+        """
+        Returns the token counts of the given items, tokenizing their texts
+        in batches without building tensors.
+        """
+        lengths = []
+        for i in range(0, len(indices), batch_size):
+            texts = [self.text_dataset[j] for j in indices[i : i + batch_size]]
+            if self.field is not None:
+                texts = [text[self.field] for text in texts]
+            lengths.extend(
+                len(token_list)
+                for token_list in self.tokenizer(
+                    texts, truncation=True, max_length=self.maxlen
+                )["input_ids"]
+            )
+        return lengths
+
+
+class PretokenizedDataset(Dataset):
+    """
+    Dataset of token sequences written by `pretokenize`, yielding the same
+    items as TokenizedDataset over the same texts. The tokens of all texts
+    are stored back to back in one memory-mapped array, and item i is the
+    slice tokens[offsets[i]:offsets[i + 1]], so nothing is tokenized or
+    copied until an item is converted into a tensor.
+    """
+
+    def __init__(self, path):
+        path = Path(path)
+        self.tokens = numpy.load(path / "tokens.npy", mmap_mode="r")
+        self.offsets = numpy.load(path / "offsets.npy")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        token_list = self.tokens[self.offsets[i] : self.offsets[i + 1]]
+        return dict(
+            input_ids=torch.from_numpy(token_list.astype(numpy.int64)),
+            position_ids=torch.arange(len(token_list)),
+            attention_mask=torch.ones(len(token_list), dtype=torch.long),
+        )
+
+    def lengths(self, indices):
+        """
+        Returns the token counts of the given items, read off the offsets.
+        """
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        return (self.offsets[indices + 1] - self.offsets[indices]).tolist()
+
+
+def pretokenize(text_dataset, tokenizer, maxlen, path, field="text", batch_size=1000):
+    """
+    Tokenizes every text of a dataset once, and writes the result to the
+    directory `path` as a flat token array (tokens.npy) plus the offsets of
+    each text within it (offsets.npy), for use with PretokenizedDataset.
+    Does nothing if `path` already exists.
+    """
+
+    path = Path(path)
+    if path.exists():
+        return path
+
+    tmp_path = path.with_name(f"{path.name}.tmp{os.getpid()}")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    dtype = numpy.uint16 if len(tokenizer) <= 2**16 else numpy.int32
+
+    offsets = [0]
+    with open(tmp_path / "tokens.bin", "wb") as f:
+        for i in range(0, len(text_dataset), batch_size):
+            texts = text_dataset[i : i + batch_size]
+            texts = texts[field] if field is not None else texts
+            for token_list in tokenizer(
+                list(texts), truncation=True, max_length=maxlen
+            )["input_ids"]:
+                f.write(numpy.asarray(token_list, dtype=dtype).tobytes())
+                offsets.append(offsets[-1] + len(token_list))
+            print(f"Tokenized {min(i + batch_size, len(text_dataset))} texts")
+
+    # Wrap the raw tokens into an .npy file, which records dtype and shape
+    raw = numpy.memmap(tmp_path / "tokens.bin", dtype=dtype, mode="r")
+    tokens = numpy.lib.format.open_memmap(
+        tmp_path / "tokens.npy", mode="w+", dtype=dtype, shape=(offsets[-1],)
+    )
+    for i in range(0, len(tokens), 1 << 26):
+        tokens[i : i + (1 << 26)] = raw[i : i + (1 << 26)]
+    tokens.flush()
+    del raw, tokens
+    os.remove(tmp_path / "tokens.bin")
+    numpy.save(tmp_path / "offsets.npy", numpy.asarray(offsets, dtype=numpy.int64))
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path)  # Written concurrently by another process
+    return path
+
 
 def dict_to_(data, device):
     """
@@ -55,28 +158,90 @@ def length_collation(token_size):
     """
 
     def collate_fn(items):
-        items = sorted(items, key=lambda x: -len(x["input_ids"]))
-        batches = []
-        batch = []
-        batch_width = 0
-        for item in items:
-            item_width = len(item["input_ids"])
-            if item_width == 0:
-                break
-            if batch_width * (len(batch) + 1) > token_size:
-                batches.append(make_padded_batch(batch))
-                batch = []
-                batch_width = 0
-            if not batch:
-                batch_width = item_width
-            batch.append(item)
-        if len(batch):
-            batches.append(make_padded_batch(batch))
-        return batches
+        lengths = [len(item["input_ids"]) for item in items]
+        return [
+            make_padded_batch([items[i] for i in batch])
+            for batch in token_budget_batches(lengths, token_size)
+        ]
 
     return collate_fn
 
 
+def token_budget_batches(lengths, token_size):
+    """
+    Splits items into batches the way `length_collation` does: sorted by
+    decreasing length, with no more than token_size tokens per batch once
+    padded to the longest item (or a single item, if it is larger). Empty
+    items are dropped. Returns lists of positions into `lengths`.
+    """
+
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    batch_width = 0
+    for i in order:
+        if lengths[i] == 0:
+            break
+        if batch_width * (len(batch) + 1) > token_size:
+            batches.append(batch)
+            batch = []
+        if not batch:
+            batch_width = lengths[i]
+        batch.append(i)
+    if len(batch):
+        batches.append(batch)
+    return batches
+
+
+def padding_efficiency(lengths, batches):
+    """
+    Fraction of the padded tokens of the given batches that are real tokens.
+    """
+
+    padded = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    return sum(lengths[i] for batch in batches for i in batch) / max(padded, 1)
+
+
+class LengthBucketedBatchSampler(Sampler):
+    """
+    Batch sampler that groups a fixed set of dataset indices by length
+    across the whole set, rather than within each chunk of a random order
+    as `length_collation` does. Lengths are computed once, up front, and
+    batches are formed by `token_budget_batches`, so every batch holds at
+    most token_size padded tokens. Batches are yielded longest first, so a
+    budget that does not fit in memory fails right away.
+
+    Each batch comes out of the DataLoader as a single collated chunk;
+    with collate_fn=length_collation(token_size), it stays one sub-batch.
+    """
+
+    def __init__(self, indices, lengths, token_size, chunk_size=100):
+        self.indices = list(indices)
+        positions = token_budget_batches(lengths, token_size)
+        self.batches = [[self.indices[i] for i in batch] for batch in positions]
+
+        # What length_collation would have padded, for comparison
+        chunked = []
+        for i in range(0, len(lengths), chunk_size):
+            chunk = lengths[i : i + chunk_size]
+            for batch in token_budget_batches(chunk, token_size):
+                chunked.append([i + j for j in batch])
+        self.efficiency = padding_efficiency(lengths, positions)
+        self.chunked_efficiency = padding_efficiency(lengths, chunked)
+        print(
+            f"Length-bucketed {len(self.indices)} samples into {len(self.batches)} "
+            f"batches of up to {token_size} tokens: padding efficiency "
+            f"{self.efficiency:.1%} (per-chunk sorting: {self.chunked_efficiency:.1%}, "
+            f"{len(chunked)} batches)"
+        )
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
 def make_padded_batch(items):
     """
     Pads sequences in a batch, so they are all the same length as the longest.
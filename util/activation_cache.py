@@ -0,0 +1,264 @@
+"""
+Cache of the residual stream entering one transformer block, per prompt.
+
+An edit of weights in block `layer` (or above) leaves the hidden states
+entering that block unchanged, for every prompt. They can thus be computed
+once, from the unedited or the edited model alike, and every later forward
+pass on the same prompt can resume at `layer` with util.partial_forward.
+
+States are keyed by a hash of the prompt's token ids, and held either in
+memory or in an on-disk store with the layout of util.edit_journal:
+
+    index.jsonl  - one JSON line per prompt, with its key, the shape of its
+                   states and the byte offset of their data.
+    states.bin   - the raw states, appended in order and read memory-mapped.
+
+In memory, only the most recently used states are kept, up to a byte
+budget; the on-disk store keeps the states of a whole dataset. Appends to
+the store hold an exclusive lock, so several runs may share it.
+"""
+
+import fcntl
+import hashlib
+import json
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+import numpy
+import torch
+from transformers import AutoModelForCausalLM
+
+from util.partial_forward import capture_block_inputs, forward_from_block
+
+
+class ActivationCache:
+    """
+    Computes logits for right-padded batches, reusing cached hidden states
+    below block `layer` whenever all prompts of the batch have been seen:
+
+        cache = ActivationCache("transformer.h.{}", 17, "transformer.ln_f")
+        logits = cache.logits(model, input_ids, attention_mask)
+
+    The model may only differ from the one the states were cached with in
+    blocks `layer` and above.
+
+    Without a `path`, states are held in memory and the least recently used
+    ones are evicted beyond `max_memory_bytes`; use a path to cache every
+    prompt of a large dataset.
+    """
+
+    def __init__(
+        self,
+        layer_module_tmp: str,
+        layer: int,
+        ln_f_module: str,
+        path: Optional[Union[str, Path]] = None,
+        dtype: str = "float32",
+        max_memory_bytes: int = 2**32,
+    ):
+        self.layer_module_tmp = layer_module_tmp
+        self.layer = layer
+        self.ln_f_module = ln_f_module
+        self.dtype = dtype
+        self.max_memory_bytes = max_memory_bytes
+        self.states: Dict[str, torch.Tensor] = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = self.misses = 0
+
+        self.path = None if path is None else Path(path)
+        self.entries = {}
+        if self.path is not None:
+            self.path.mkdir(exist_ok=True, parents=True)
+            self.index_file = self.path / "index.jsonl"
+            self.data_file = self.path / "states.bin"
+            if self.index_file.exists():
+                with open(self.index_file, "r") as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            self.entries[entry["key"]] = entry
+            self._data = None
+
+    def __len__(self):
+        return len(self.entries) if self.path is not None else len(self.states)
+
+    @staticmethod
+    def key(token_ids: torch.Tensor) -> str:
+        return hashlib.md5(
+            token_ids.cpu().to(torch.int64).numpy().tobytes()
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        if self.path is None:
+            if key in self.states:
+                self.states.move_to_end(key)
+            return self.states.get(key)
+        if key not in self.entries:
+            return None
+        entry = self.entries[key]
+        dtype = numpy.dtype(entry["dtype"])
+        nbytes = int(numpy.prod(entry["shape"])) * dtype.itemsize
+        if self._data is None or len(self._data) < entry["offset"] + nbytes:
+            self._data = numpy.memmap(self.data_file, dtype=numpy.uint8, mode="r")
+        data = self._data[entry["offset"] : entry["offset"] + nbytes]
+        return torch.from_numpy(
+            numpy.frombuffer(data, dtype=dtype).reshape(entry["shape"]).copy()
+        )
+
+    def put(self, states: Dict[str, torch.Tensor]):
+        """
+        Stores the hidden states [n_tokens, n_embd] of several prompts.
+        """
+
+        dtype = getattr(torch, self.dtype)
+        states = {k: v.detach().cpu().to(dtype) for k, v in states.items()}
+        if self.path is None:
+            for k, v in states.items():
+                if k in self.states:
+                    self.memory_bytes -= self._nbytes(self.states.pop(k))
+                self.states[k] = v
+                self.memory_bytes += self._nbytes(v)
+            while self.memory_bytes > self.max_memory_bytes and len(self.states) > 1:
+                _, v = self.states.popitem(last=False)
+                self.memory_bytes -= self._nbytes(v)
+            return
+
+        with open(self.data_file, "ab") as data_f, open(self.index_file, "a") as idx_f:
+            # Other runs may append to the same store; the lock keeps the
+            # offsets of their writes and ours apart
+            fcntl.flock(idx_f, fcntl.LOCK_EX)
+            offset = data_f.seek(0, 2)
+            for k, v in states.items():
+                if k in self.entries:
+                    continue
+                x = v.contiguous().numpy()
+                entry = dict(
+                    key=k, dtype=self.dtype, offset=offset, shape=list(x.shape)
+                )
+                data_f.write(x.tobytes())
+                offset += x.nbytes
+                idx_f.write(json.dumps(entry) + "\n")
+                self.entries[k] = entry
+            data_f.flush()
+            idx_f.flush()
+            fcntl.flock(idx_f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _nbytes(x: torch.Tensor) -> int:
+        return x.numel() * x.element_size()
+
+    def logits(
+        self,
+        model: AutoModelForCausalLM,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Returns the logits of a right-padded batch. If any prompt is missing
+        from the cache, the lower blocks are run on the whole batch and the
+        missing states are stored; otherwise, only the embeddings are run,
+        to recover the arguments of the blocks.
+        """
+
+        lengths = attention_mask.sum(1).tolist()
+        keys = [self.key(ids[:n]) for ids, n in zip(input_ids, lengths)]
+        cached = [self.get(k) for k in keys]
+
+        if any(x is None for x in cached):
+            self.misses += 1
+            block_inputs = capture_block_inputs(
+                model,
+                self.layer_module_tmp,
+                self.layer,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+            )
+            h = block_inputs.hidden_states
+            self.put(
+                {
+                    k: h[i, :n]
+                    for i, (k, n, x) in enumerate(zip(keys, lengths, cached))
+                    if x is None
+                }
+            )
+        else:
+            self.hits += 1
+            # Block arguments (masks, positions) do not depend on the layer
+            block_inputs = capture_block_inputs(
+                model,
+                self.layer_module_tmp,
+                0,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+            )
+            emb = block_inputs.hidden_states
+            h = torch.zeros_like(emb)
+            for i, (x, n) in enumerate(zip(cached, lengths)):
+                h[i, :n] = x.to(h.device, h.dtype)
+
+        return forward_from_block(
+            model,
+            block_inputs,
+            self.layer_module_tmp,
+            self.layer,
+            self.ln_f_module,
+            hidden_states=h,
+        )
+
+
+# Unit Tests
+def _unit_test():
+    import tempfile
+
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(n_layer=6, n_embd=64, n_head=4, n_positions=64, vocab_size=1000)
+    ).eval()
+
+    input_ids = torch.randint(0, 1000, (3, 12))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 8:] = 0
+    attention_mask[2, 5:] = 0
+    mask = attention_mask.bool()
+
+    with torch.no_grad(), tempfile.TemporaryDirectory() as tmp:
+        for path in [None, tmp]:
+            cache = ActivationCache("transformer.h.{}", 3, "transformer.ln_f", path)
+            full = model(input_ids=input_ids, attention_mask=attention_mask).logits
+            for _ in range(2):
+                logits = cache.logits(model, input_ids, attention_mask)
+                err = (full[mask] - logits[mask]).abs().max().item()
+                assert err < 1e-4, err
+
+            # Edits at the cached layer take effect; stores can be reopened,
+            # and batches regrouped
+            model.transformer.h[3].mlp.c_proj.weight.add_(0.1)
+            full = model(input_ids=input_ids, attention_mask=attention_mask).logits
+            if path is not None:
+                cache = ActivationCache("transformer.h.{}", 3, "transformer.ln_f", path)
+            hits, order = cache.hits, [2, 0]
+            logits = cache.logits(model, input_ids[order], attention_mask[order])
+            err = (full[order][mask[order]] - logits[mask[order]]).abs().max().item()
+            print(f"Store {path}: {len(cache)} prompts, max abs error {err}")
+            assert err < 1e-4 and cache.hits == hits + 1, err
+            model.transformer.h[3].mlp.c_proj.weight.sub_(0.1)
+
+        # In memory, the least recently used states are evicted
+        cache = ActivationCache(
+            "transformer.h.{}", 3, "transformer.ln_f", max_memory_bytes=13 * 64 * 4
+        )
+        cache.logits(model, input_ids, attention_mask)
+        assert len(cache) == 2 and cache.memory_bytes == (8 + 5) * 64 * 4
+        logits = cache.logits(model, input_ids[:1], attention_mask[:1])
+        assert len(cache) == 1 and cache.misses == 2
+        err = (full[:1][mask[:1]] - logits[mask[:1]]).abs().max().item()
+        assert err < 1e-4, err
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
@@ -0,0 +1,183 @@
+"""
+Tracks how far edited weights have moved from their original values,
+without keeping a second copy of the model.
+
+Only the tracked weights are snapshotted. Low-rank deltas (the (u, v) pairs
+of ROME, or (U, V) factors with one column per rank) are accumulated as
+factors, and the squared Frobenius norm of their sum is updated with Gram
+products of the factors alone:
+
+    |D + u v^T|^2 = |D|^2 + 2 <U^T u, V^T v> + |u|^2 |v|^2,   D = U V^T
+
+so the dense update is never formed. Weights changed by dense deltas, e.g.
+by FT, are compared against their snapshot instead.
+"""
+
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
+
+from util import nethook
+
+
+class EditDistanceTracker:
+    """
+    Follows the edits applied to some weights of a model:
+
+        tracker = EditDistanceTracker(model, ["transformer.h.17.mlp.c_proj.weight"])
+        tracker.append({"transformer.h.17.mlp.c_proj.weight": (u, v)})
+        ...
+        tracker.distances(model)  # {weight name: |W - W_orig| / numel}
+        tracker.reset()  # after restoring the original weights
+    """
+
+    def __init__(self, model: torch.nn.Module, weight_names: List[str]):
+        self.weight_names = list(weight_names)
+        with torch.no_grad():
+            self.originals = {
+                w_name: nethook.get_parameter(model, w_name).detach().cpu().clone()
+                for w_name in self.weight_names
+            }
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all edits, once the weights are back to their original values.
+        """
+
+        self.factors: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self._buffers: Dict[str, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self.sq_norms = {w_name: 0.0 for w_name in self.weight_names}
+        self.dense = set()
+
+    def append(
+        self,
+        deltas: Dict[str, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]],
+    ):
+        """
+        Records the deltas of one edit, in the format of `EditJournal.append`.
+        Deltas of untracked weights are ignored.
+        """
+
+        for w_name, delta in deltas.items():
+            if w_name not in self.sq_norms:
+                continue
+            if not isinstance(delta, (tuple, list)):
+                self.dense.add(w_name)
+                continue
+
+            u, v = (x.detach().view(len(x), -1).double() for x in delta)
+            sq_norm = ((u.T @ u) * (v.T @ v)).sum()
+            if w_name in self.factors:
+                U, V = self.factors[w_name]
+                u, v = u.to(U.device), v.to(V.device)
+                sq_norm = sq_norm.to(U.device) + 2 * ((U.T @ u) * (V.T @ v)).sum()
+            self._append(w_name, u, v)
+            self.sq_norms[w_name] += sq_norm.item()
+
+    def _append(self, w_name: str, u: torch.Tensor, v: torch.Tensor):
+        """
+        Stacks new factors after those of a weight, in buffers that grow
+        geometrically, so that each edit only copies its own factors.
+        """
+
+        rank = self.factors[w_name][0].size(1) if w_name in self.factors else 0
+        new_rank = rank + u.size(1)
+        if w_name not in self._buffers or self._buffers[w_name][0].size(1) < new_rank:
+            capacity = max(new_rank, 2 * rank, 16)
+            buffers = []
+            for x, old in zip((u, v), self.factors.get(w_name, (None, None))):
+                buf = x.new_empty(len(x), capacity)
+                if old is not None:
+                    buf[:, :rank] = old
+                buffers.append(buf)
+            self._buffers[w_name] = tuple(buffers)
+
+        U, V = self._buffers[w_name]
+        U[:, rank:new_rank] = u
+        V[:, rank:new_rank] = v
+        self.factors[w_name] = (U[:, :new_rank], V[:, :new_rank])
+
+    def deltas(self) -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Returns the factors (U, V) accumulated for each weight since the last
+        reset, in the format of `append`.
+        """
+
+        return {
+            w_name: (U.float(), V.float()) for w_name, (U, V) in self.factors.items()
+        }
+
+    def distances(self, model: Optional[torch.nn.Module] = None) -> Dict[str, float]:
+        """
+        Returns |W - W_orig|_F / numel(W) for every tracked weight, as the
+        evaluation has always reported it. The model is only needed if some
+        weight was changed by a dense delta.
+        """
+
+        ret = {}
+        with torch.no_grad():
+            for w_name in self.weight_names:
+                original = self.originals[w_name]
+                if w_name in self.dense:
+                    assert model is not None, f"{w_name} has dense edits"
+                    w = nethook.get_parameter(model, w_name)
+                    distance = torch.norm(w - original.to(w.device)).item()
+                else:
+                    distance = max(self.sq_norms[w_name], 0.0) ** 0.5
+                ret[w_name] = distance / original.numel()
+
+        return ret
+
+
+# Unit Tests
+def _unit_test():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(24, 16), torch.nn.Linear(16, 8))
+    weight_names = ["0.weight", "1.weight"]
+    tracker = EditDistanceTracker(model, weight_names)
+
+    def check():
+        distances = tracker.distances(model)
+        for w_name in weight_names:
+            w = nethook.get_parameter(model, w_name)
+            expected = torch.norm(w - tracker.originals[w_name]).item() / w.numel()
+            assert abs(distances[w_name] - expected) < 1e-6 * max(expected, 1), (
+                w_name,
+                distances[w_name],
+                expected,
+            )
+
+    # Rank-1 and rank-k edits, enough of them to grow the buffers; factors
+    # are (input, output), i.e. the delta of a Linear weight is (u v^T)^T
+    with torch.no_grad():
+        for i in range(40):
+            deltas = {}
+            for w_name in weight_names:
+                w = nethook.get_parameter(model, w_name)
+                k = 1 if i % 2 else 3
+                u, v = torch.randn(w.shape[1], k), torch.randn(w.shape[0], k)
+                if k == 1:
+                    u, v = u[:, 0], v[:, 0]
+                w.add_((u.view(len(u), -1) @ v.view(len(v), -1).T).T)
+                deltas[w_name] = (u, v)
+            tracker.append(deltas)
+            check()
+        assert tracker.deltas()["0.weight"][0].shape == (24, 80)
+
+        # Back to the original weights, then one dense edit
+        for w_name in weight_names:
+            nethook.get_parameter(model, w_name)[...] = tracker.originals[w_name]
+        tracker.reset()
+        check()
+        w = nethook.get_parameter(model, "1.weight")
+        dense = torch.randn_like(w)
+        w.add_(dense)
+        tracker.append({"1.weight": dense})
+        check()
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
@@ -0,0 +1,201 @@
+"""
+On-disk journal of the weight deltas applied by editing algorithms.
+
+A journal is a directory with two files:
+
+    index.jsonl  - one JSON line per stored tensor group, recording the step
+                   (edit number), the weight name, the kind of delta, the
+                   shapes and the byte offset of its data.
+    deltas.bin   - the raw tensor data, appended in order.
+
+Low-rank deltas (the (u, v) pairs of ROME, or (U, V) factors with one column
+per rank) are stored as factors; any other delta, e.g. from FT, is stored
+densely. Replaying a prefix of the history stacks all factors of a weight
+and applies them with a single U @ V^T product per weight.
+"""
+
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy
+import torch
+
+from util import nethook
+
+
+class EditJournal:
+    """
+    Append-only record of edits, which can be replayed onto a fresh model:
+
+        journal = EditJournal(run_dir / "journal")
+        journal.append({"transformer.h.17.mlp.c_proj.weight": (u, v)})
+        ...
+        journal.replay(model, upto=100)  # model state after the first 100 edits
+    """
+
+    def __init__(self, path: Union[str, Path], dtype: str = "float32"):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
+        self.index_file = self.path / "index.jsonl"
+        self.data_file = self.path / "deltas.bin"
+        self.dtype = dtype
+        self.entries = self._read_index()
+        self.n_steps = 1 + max((e["step"] for e in self.entries), default=-1)
+
+    def __len__(self):
+        return self.n_steps
+
+    def append(
+        self,
+        deltas: Dict[str, Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]],
+        step: Optional[int] = None,
+    ) -> int:
+        """
+        Records the deltas of one edit and returns its step. Values are either
+        (u, v) factors, with the update u v^T in the orientation used by
+        ROME, or dense update matrices in the shape of the weight.
+        """
+
+        if step is None:
+            step = self.n_steps
+        self.n_steps = max(self.n_steps, step + 1)
+
+        offset = self.data_file.stat().st_size if self.data_file.exists() else 0
+        with open(self.data_file, "ab") as data_f, open(self.index_file, "a") as idx_f:
+            for w_name, delta in deltas.items():
+                if isinstance(delta, (tuple, list)):
+                    kind, arrays = "lowrank", [
+                        x.detach().view(len(x), -1).T for x in delta
+                    ]
+                else:
+                    kind, arrays = "dense", [delta.detach()]
+                arrays = [
+                    x.cpu().to(getattr(torch, self.dtype)).contiguous().numpy()
+                    for x in arrays
+                ]
+
+                entry = dict(
+                    step=step,
+                    w_name=w_name,
+                    kind=kind,
+                    dtype=self.dtype,
+                    offset=offset,
+                    shapes=[list(x.shape) for x in arrays],
+                )
+                for x in arrays:
+                    data_f.write(x.tobytes())
+                    offset += x.nbytes
+                idx_f.write(json.dumps(entry) + "\n")
+                self.entries.append(entry)
+
+        return step
+
+    def replay(self, model: torch.nn.Module, upto: Optional[int] = None) -> List[str]:
+        """
+        Adds the deltas of steps [0, upto) to the weights of `model`, which
+        should be in the state the journal started from. Returns the names
+        of the weights that changed.
+        """
+
+        from rome.rome_main import upd_matrix_match_shape
+
+        entries = [e for e in self.entries if upto is None or e["step"] < upto]
+        if len(entries) == 0:
+            return []
+        data = numpy.memmap(self.data_file, dtype=numpy.uint8, mode="r")
+
+        w_names = list(dict.fromkeys(e["w_name"] for e in entries))
+        with torch.no_grad():
+            for w_name in w_names:
+                w = nethook.get_parameter(model, w_name)
+                upd_matrix = torch.zeros_like(w)
+
+                w_entries = [e for e in entries if e["w_name"] == w_name]
+                dense = [e for e in w_entries if e["kind"] == "dense"]
+                lowrank = [e for e in w_entries if e["kind"] == "lowrank"]
+
+                for e in dense:
+                    upd_matrix += self._load(data, e)[0].to(w.device, w.dtype)
+
+                if len(lowrank) > 0:
+                    # Factors are stored as [rank, dim]; stack them all
+                    U, V = (
+                        torch.cat(x, dim=0).to(w.device, torch.float32)
+                        for x in zip(*(self._load(data, e) for e in lowrank))
+                    )
+                    upd_matrix += upd_matrix_match_shape(U.T @ V, w.shape).to(w.dtype)
+
+                w[...] += upd_matrix
+
+        print(f"Replayed {len(entries)} deltas into {w_names}")
+        return w_names
+
+    def _load(self, data, entry) -> List[torch.Tensor]:
+        dtype = numpy.dtype(entry["dtype"])
+        offset, ret = entry["offset"], []
+        for shape in entry["shapes"]:
+            nbytes = int(numpy.prod(shape)) * dtype.itemsize
+            ret.append(
+                torch.from_numpy(
+                    numpy.frombuffer(data[offset : offset + nbytes], dtype=dtype)
+                    .reshape(shape)
+                    .copy()
+                )
+            )
+            offset += nbytes
+        return ret
+
+    def _read_index(self):
+        if not self.index_file.exists():
+            return []
+        with open(self.index_file, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+# Unit Tests
+def _unit_test():
+    import copy
+    import tempfile
+
+    from rome.rome_main import upd_matrix_match_shape
+
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(24, 16), torch.nn.Linear(16, 8))
+    original = copy.deepcopy(model)
+
+    # Rank-1, rank-k and dense deltas, written into the weights one by one
+    states = [copy.deepcopy(model.state_dict())]
+    with torch.no_grad(), tempfile.TemporaryDirectory() as tmp:
+        journal = EditJournal(tmp)
+        for step in range(6):
+            deltas = {"0.weight": (torch.randn(24), torch.randn(16))}
+            if step % 2:
+                deltas["1.weight"] = (torch.randn(16, 2), torch.randn(8, 2))
+            if step % 3 == 2:
+                deltas["0.bias"] = torch.randn(16)
+            for w_name, delta in deltas.items():
+                w = nethook.get_parameter(model, w_name)
+                if isinstance(delta, tuple):
+                    u, v = (x.view(len(x), -1) for x in delta)
+                    delta = upd_matrix_match_shape(u @ v.T, w.shape)
+                w[...] += delta
+            assert journal.append(deltas) == step
+            states.append(copy.deepcopy(model.state_dict()))
+
+        # Every prefix, replayed from a reopened journal, matches
+        journal = EditJournal(tmp)
+        assert len(journal) == 6
+        for upto in [0, 1, 4, 6, None]:
+            replayed = copy.deepcopy(original)
+            journal.replay(replayed, upto=upto)
+            expected = states[6 if upto is None else upto]
+            for k, v in replayed.state_dict().items():
+                err = (v - expected[k]).abs().max().item()
+                assert err < 1e-5, (upto, k, err)
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
@@ -122,8 +122,9 @@ class TraceDict(OrderedDict, contextlib.AbstractContextManager):
     modified output.
 
     Other arguments are the same as Trace.  If stop is True, then the
-    execution of the network will be stopped after the last layer
-    listed (even if it would not have been the last to be executed).
+    execution of the network will be stopped as soon as every listed
+    layer has run, i.e. right after the deepest of them, regardless of
+    the order in which the layers are listed.
     """
 
     def __init__(
@@ -140,21 +141,8 @@ class TraceDict(OrderedDict, contextlib.AbstractContextManager):
     ):
         self.stop = stop
 
-        def flag_last_unseen(it):
-            try:
-                it = iter(it)
-                prev = next(it)
-                seen = set([prev])
-            except StopIteration:
-                return
-            for item in it:
-                if item not in seen:
-                    yield False, prev
-                    seen.add(item)
-                    prev = item
-            yield True, prev
-
-        for is_last, layer in flag_last_unseen(layers):
+        # Each layer is traced once, in the order first listed
+        for layer in dict.fromkeys(layers or []):
             self[layer] = Trace(
                 module=module,
                 layer=layer,
@@ -164,9 +152,33 @@ class TraceDict(OrderedDict, contextlib.AbstractContextManager):
                 detach=detach,
                 retain_grad=retain_grad,
                 edit_output=edit_output,
-                stop=stop and is_last,
             )
 
+        # Stopping is done by separate hooks, registered after the retaining
+        # ones, which stop once all the layers have been seen. Every forward
+        # pass of the network starts with all of them pending, even if the
+        # previous one was interrupted before reaching them.
+        self.stop_hooks = []
+        if stop:
+            pending = set(self.keys())
+
+            def reset_hook(m, inputs):
+                pending.clear()
+                pending.update(self.keys())
+
+            def stop_hook_for(layer):
+                def stop_hook(m, inputs, output):
+                    pending.discard(layer)
+                    if not pending:
+                        raise StopForward()
+
+                return stop_hook
+
+            self.stop_hooks = [module.register_forward_pre_hook(reset_hook)] + [
+                get_module(module, layer).register_forward_hook(stop_hook_for(layer))
+                for layer in self.keys()
+            ]
+
     def __enter__(self):
         return self
 
@@ -176,6 +188,8 @@ class TraceDict(OrderedDict, contextlib.AbstractContextManager):
             return True
 
     def close(self):
+        for hook in self.stop_hooks:
+            hook.remove()
         for layer, trace in reversed(self.items()):
             trace.close()
 
@@ -0,0 +1,163 @@
+"""
+Utilities for running only the upper part of a transformer.
+
+capture_block_inputs records the arguments a model passes into one of its
+transformer blocks, stopping the forward pass right there.
+forward_from_block resumes the computation from those captured arguments,
+running the remaining blocks and (optionally) the final norm and LM head.
+
+This is useful whenever an intervention only affects layers at or above a
+given block: everything below it can be computed once and reused.
+"""
+
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+import torch.utils.checkpoint
+from transformers import AutoModelForCausalLM
+
+from util import nethook
+
+
+class BlockInputs:
+    """
+    Arguments passed into a transformer block, split into the hidden state
+    (the residual stream entering the block) and everything else (attention
+    masks, position ids, rotary embeddings, ...). The latter do not depend
+    on the layer index, so they can be reused for every block above.
+    """
+
+    def __init__(self, hidden_states: torch.Tensor, args: Tuple, kwargs: Dict):
+        self.hidden_states = hidden_states
+        self.args = args
+        self.kwargs = kwargs
+
+
+def capture_block_inputs(
+    model: AutoModelForCausalLM,
+    layer_module_tmp: str,
+    layer: int,
+    **inputs: Any,
+) -> BlockInputs:
+    """
+    Runs the model on `inputs` until it reaches block `layer`, and returns
+    the arguments that block would have been called with. Layers at and
+    above `layer` are never executed.
+    """
+
+    block = nethook.get_module(model, layer_module_tmp.format(layer))
+    captured = {}
+
+    def capture_hook(m, args, kwargs):
+        captured["args"], captured["kwargs"] = args, dict(kwargs)
+        raise nethook.StopForward()
+
+    handle = block.register_forward_pre_hook(capture_hook, with_kwargs=True)
+    try:
+        # The KV cache is never needed when resuming from a block, and some
+        # versions of transformers would otherwise pass a mutable cache object.
+        model(**inputs, use_cache=False)
+    except nethook.StopForward:
+        pass
+    finally:
+        handle.remove()
+
+    assert "args" in captured, f"Block {layer} was never called"
+    args, kwargs = captured["args"], captured["kwargs"]
+    if len(args) > 0:
+        hidden_states, args = args[0], args[1:]
+    else:
+        hidden_states = kwargs.pop("hidden_states")
+
+    return BlockInputs(hidden_states, args, kwargs)
+
+
+def forward_from_block(
+    model: AutoModelForCausalLM,
+    block_inputs: BlockInputs,
+    layer_module_tmp: str,
+    layer: int,
+    ln_f_module: Optional[str] = None,
+    hidden_states: Optional[torch.Tensor] = None,
+    checkpoint: bool = False,
+) -> torch.Tensor:
+    """
+    Resumes a forward pass at block `layer`, using the arguments recorded by
+    `capture_block_inputs`. Any hooks registered on modules within the
+    remaining blocks (e.g. nethook.Trace edits) are run as usual.
+
+    :param hidden_states: Overrides the captured residual stream, e.g. when
+        it was cached from a different call.
+    :param ln_f_module: If given, the final layer norm and LM head are applied
+        and logits are returned; otherwise, the hidden states after the last
+        block are returned.
+    :param checkpoint: Recompute block activations during the backward pass
+        instead of storing them.
+    """
+
+    h = block_inputs.hidden_states if hidden_states is None else hidden_states
+    for i in range(layer, model.config.n_layer):
+        block = nethook.get_module(model, layer_module_tmp.format(i))
+        if checkpoint and torch.is_grad_enabled():
+            out = torch.utils.checkpoint.checkpoint(
+                block,
+                h,
+                *block_inputs.args,
+                use_reentrant=False,
+                **block_inputs.kwargs,
+            )
+        else:
+            out = block(h, *block_inputs.args, **block_inputs.kwargs)
+        h = out[0] if isinstance(out, tuple) else out
+
+    if ln_f_module is None:
+        return h
+
+    return hidden_to_logits(model, ln_f_module, h)
+
+
+def hidden_to_logits(
+    model: AutoModelForCausalLM, ln_f_module: str, hidden_states: torch.Tensor
+) -> torch.Tensor:
+    """
+    Applies the final layer norm and LM head to hidden states of any shape
+    [..., n_embd].
+    """
+
+    ln_f = nethook.get_module(model, ln_f_module)
+    return model.get_output_embeddings()(ln_f(hidden_states))
+
+
+# Unit Tests
+def _unit_test():
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(n_layer=6, n_embd=64, n_head=4, n_positions=64, vocab_size=1000)
+    ).eval()
+
+    # Right-padded batch, as produced by the GPT-2 tokenizer.
+    input_ids = torch.randint(0, 1000, (3, 12))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, 8:] = 0
+    attention_mask[2, 5:] = 0
+    inp = dict(input_ids=input_ids, attention_mask=attention_mask)
+
+    with torch.no_grad():
+        full = model(**inp).logits
+        for layer in [0, 2, 5]:
+            block_inputs = capture_block_inputs(model, "transformer.h.{}", layer, **inp)
+            partial = forward_from_block(
+                model, block_inputs, "transformer.h.{}", layer, "transformer.ln_f"
+            )
+            mask = attention_mask.bool()
+            err = (full[mask] - partial[mask]).abs().max().item()
+            print(f"Layer {layer}: max abs error {err}")
+            assert err < 1e-4
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()
@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
@@ -15,10 +17,77 @@ def perplexity(
 
     inputs = tok(
         [text], return_tensors="pt", max_length=max_input_length, truncation=True
-    ).to("cuda")
+    ).to(next(model.parameters()).device)
 
     logits = torch.nn.functional.log_softmax(model(**inputs).logits, dim=2)
     log_probs = torch.gather(logits[:, :-1, :], 2, inputs["input_ids"][:, 1:, None])[0]
 
     # Perplexity = exp(-1/N * log P(x_1, ..., x_n))
     return torch.exp(-1 / inputs["input_ids"].size(1) * log_probs.sum()).item()
+
+
+def perplexity_batch(
+    model: AutoModelForCausalLM,
+    tok: AutoTokenizer,
+    texts: List[str],
+    max_input_length: int = None,
+) -> List[float]:
+    """
+    Computes the perplexity of several texts in one right-padded batch, with
+    the same definition and truncation as `perplexity`.
+    """
+
+    inputs = tok(
+        texts,
+        padding=True,
+        return_tensors="pt",
+        max_length=max_input_length,
+        truncation=True,
+    ).to(next(model.parameters()).device)
+
+    with torch.no_grad():
+        logits = torch.nn.functional.log_softmax(model(**inputs).logits, dim=2)
+        log_probs = torch.gather(
+            logits[:, :-1, :], 2, inputs["input_ids"][:, 1:, None]
+        )[:, :, 0]
+        mask = inputs["attention_mask"]
+        log_probs = (log_probs * mask[:, 1:]).sum(1)
+
+        # Perplexity = exp(-1/N * log P(x_1, ..., x_n))
+        return torch.exp(-log_probs / mask.sum(1)).tolist()
+
+
+# Unit Tests
+def _unit_test():
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    vocab = {f"w{i}": i for i in range(999)}
+    vocab["[PAD]"] = 999
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="[PAD]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    tok = PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]")
+
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(
+        GPT2Config(n_layer=2, n_embd=64, n_head=4, n_positions=64, vocab_size=1000)
+    ).eval()
+
+    # Texts of different lengths, some truncated
+    texts = [
+        " ".join(f"w{i}" for i in torch.randint(0, 999, (n,)).tolist())
+        for n in [3, 17, 8, 40]
+    ]
+    for max_input_length in [None, 20]:
+        batched = perplexity_batch(model, tok, texts, max_input_length)
+        with torch.no_grad():
+            single = [perplexity(model, tok, t, max_input_length) for t in texts]
+        err = max(abs(a - b) / b for a, b in zip(batched, single))
+        print(f"max_input_length={max_input_length}: max rel error {err}")
+        assert err < 1e-5, err
+
+    print("OK")
+
+
+if __name__ == "__main__":
+    _unit_test()